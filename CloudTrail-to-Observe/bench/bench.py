@@ -0,0 +1,231 @@
+"""
+End to end benchmark of the CloudTrail-to-Observe Lambda without AWS or Observe.
+Builds synthetic CloudTrail objects, serves them through an in-memory S3 stand-in,
+points the Observe shipper at a local HTTP sink (running in its own process, with
+optional latency and error injection) and runs main.lambda_handler.
+
+Results are appended as one JSON line per run to --output, so runs before and after
+a change to main.py/observe.py can be compared.
+
+Example:
+    python bench.py --objects 20 --records 5000 --read-only-share 0.7 --latency-ms 20 --error-rate 0.05
+"""
+import io
+import os
+import sys
+import gzip
+import json
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from time import time, sleep
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code")
+
+READ_ONLY_EVENTS = [
+    ("ec2.amazonaws.com", "DescribeInstances"),
+    ("s3.amazonaws.com", "ListBuckets"),
+    ("iam.amazonaws.com", "GetRole"),
+    ("sts.amazonaws.com", "GetCallerIdentity"),
+]
+WRITE_EVENTS = [
+    ("ec2.amazonaws.com", "RunInstances"),
+    ("s3.amazonaws.com", "PutObject"),
+    ("iam.amazonaws.com", "AttachRolePolicy"),
+    ("ec2.amazonaws.com", "CreateTags"),
+]
+
+
+def synthetic_record(index, read_only_share, service_share, payload_bytes, rng):
+    read_only = rng.random() < read_only_share
+    event_source, event_name = rng.choice(READ_ONLY_EVENTS if read_only else WRITE_EVENTS)
+    by_service = rng.random() < service_share
+    event_time = datetime(2025, 8, 1, tzinfo=timezone.utc) + timedelta(seconds=index)
+    return {
+        "eventVersion": "1.09",
+        "userIdentity": {
+            "type": "AWSService" if by_service else "IAMUser",
+            "principalId": f"AIDA{index:016d}",
+            "arn": "arn:aws:iam::123456789012:user/bench",
+            "accountId": "123456789012",
+        },
+        "eventTime": event_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "eventSource": event_source,
+        "eventName": event_name,
+        "awsRegion": "us-east-1",
+        "sourceIPAddress": f"10.0.{index % 256}.{rng.randint(1, 254)}",
+        "userAgent": "aws-cli/2.17.0",
+        "requestParameters": {"instanceId": f"i-{index:017x}"},
+        "responseElements": {"payload": "x" * rng.randint(0, payload_bytes)} if not read_only else None,
+        "requestID": f"{rng.getrandbits(128):032x}",
+        "eventID": f"{rng.getrandbits(128):032x}",
+        "readOnly": read_only,
+        "eventType": "AwsApiCall",
+        "managementEvent": True,
+        "recipientAccountId": "123456789012",
+    }
+
+
+def build_object(object_index, records, read_only_share, service_share, payload_bytes, seed):
+    rng = random.Random(seed * 100003 + object_index)
+    key = f"AWSLogs/123456789012/CloudTrail/us-east-1/2025/08/01/123456789012_CloudTrail_us-east-1_{object_index:05d}.json.gz"
+    document = {"Records": [synthetic_record(object_index * records + i, read_only_share, service_share, payload_bytes, rng)
+                            for i in range(records)]}
+    return key, gzip.compress(json.dumps(document, separators=(",", ":")).encode("utf-8"))
+
+
+def build_objects(count, records, read_only_share, service_share, payload_bytes, seed):
+    # Built in worker processes so the decoded documents do not count towards the measured peak RSS
+    with multiprocessing.Pool() as pool:
+        built = pool.starmap(build_object, [(i, records, read_only_share, service_share, payload_bytes, seed)
+                                            for i in range(count)])
+    return dict(built)
+
+
+class LocalS3:
+    """
+    In-memory stand-in for the S3 client calls used by main.py.
+    """
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key, **kwargs):
+        from botocore.response import StreamingBody
+        data = self.objects[Key]
+        return {"Body": StreamingBody(io.BytesIO(data), len(data)), "ETag": f"\"{hash(Key):x}\""}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        return {"ETag": f"\"{hash(Key):x}\"", "ContentLength": len(self.objects[Key])}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        with open(Filename, "wb") as f:
+            f.write(self.objects[Key])
+
+
+def run_sink(port, latency_ms, error_rate, counters, ready):
+    class SinkHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if latency_ms:
+                sleep(latency_ms / 1000)
+            failed = random.random() < error_rate
+            with counters.get_lock():
+                counters[0] += 1
+                counters[1] += len(body)
+                counters[2] += 1 if failed else 0
+            self.send_response(503 if failed else 200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SinkHandler)
+    port.value = server.server_port
+    ready.set()
+    server.serve_forever()
+
+
+def start_sink(latency_ms, error_rate):
+    # Counters: requests, body bytes, injected errors
+    counters = multiprocessing.Array("q", 3)
+    port = multiprocessing.Value("i", 0)
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=run_sink, args=(port, latency_ms, error_rate, counters, ready), daemon=True)
+    process.start()
+    ready.wait(10)
+    return process, port.value, counters
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=CODE_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the CloudTrail-to-Observe Lambda against local stand-ins")
+    parser.add_argument("--objects", type=int, default=10, help="Number of synthetic CloudTrail objects")
+    parser.add_argument("--records", type=int, default=2000, help="Records per object")
+    parser.add_argument("--read-only-share", type=float, default=0.6, help="Share of read-only (Describe/List/Get) events")
+    parser.add_argument("--service-share", type=float, default=0.2, help="Share of events made by AWS service principals")
+    parser.add_argument("--payload-bytes", type=int, default=512, help="Max size of the synthetic responseElements")
+    parser.add_argument("--objects-per-event", type=int, default=10, help="S3 records per Lambda event")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Latency added by the sink per request")
+    parser.add_argument("--error-rate", type=float, default=0, help="Share of sink requests answered with 503")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="", help="Free text stored with the results")
+    parser.add_argument("--output", default="bench_results.jsonl", help="JSON lines file the results are appended to")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    objects = build_objects(args.objects, args.records, args.read_only_share, args.service_share, args.payload_bytes, args.seed)
+    sink_process, sink_port, counters = start_sink(args.latency_ms, args.error_rate)
+
+    # Configure the Lambda module before it builds its module level clients
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("CUSTOMER_ID", "bench")
+    os.environ.setdefault("TOKEN", "bench")
+    os.environ["IDEMPOTENCY_TABLE"] = ""
+    os.environ.pop("SPOOL_BUCKET", None)
+    os.environ.setdefault("SPOOL_DIR", tempfile.mkdtemp(prefix="observe-spool-"))
+    sys.path.insert(0, CODE_DIR)
+    import main as lambda_main
+
+    lambda_main.s3_client = LocalS3(objects)
+    lambda_main.shipper.logs_endpoint = f"http://127.0.0.1:{sink_port}/v1/http"
+
+    keys = list(objects)
+    results = []
+    started = time()
+    for i in range(0, len(keys), args.objects_per_event):
+        event = {"Records": [{"s3": {"bucket": {"name": "bench"}, "object": {"key": key, "eTag": f"{hash(key):x}"}}}
+                             for key in keys[i:i + args.objects_per_event]]}
+        results.extend(lambda_main.lambda_handler(event, None)["results"])
+    elapsed = time() - started
+
+    shipper_stats = lambda_main.shipper.connection_stats()
+    filter_stats = lambda_main.record_filter.stats(shipper_stats["bytes_serialized"])
+    sink_process.terminate()
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "label": args.label,
+        "config": vars(args) | {
+            "stream_decode": os.getenv("STREAM_DECODE", "True"),
+            "output_format": os.getenv("OUTPUT_FORMAT", "json"),
+            "filter_rules": bool(os.getenv("FILTER_RULES")),
+        },
+        "seconds": round(elapsed, 3),
+        "objects": len(keys),
+        "objects_failed": len([result for result in results if not result["success"]]),
+        "records_in": filter_stats["records_in"],
+        "records_sent": shipper_stats["records_sent"],
+        "records_per_second": round(filter_stats["records_in"] / elapsed, 1) if elapsed else None,
+        "input_bytes": sum(len(data) for data in objects.values()),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "wire_bytes": counters[1],
+        "requests": counters[0],
+        "injected_errors": counters[2],
+        "shipper": shipper_stats,
+        "filter": filter_stats,
+    }
+    with open(args.output, "a") as f:
+        f.write(json.dumps(report) + "\n")
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
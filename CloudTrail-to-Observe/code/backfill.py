@@ -0,0 +1,218 @@
+"""
+Backfill / replay of CloudTrail objects already stored in the trail bucket.
+Reuses the Lambda decode and shipping code (main.process_object) on a process pool.
+Observe settings are read from the same environment variables as the Lambda
+(CUSTOMER_ID, TOKEN, EXTRA, BATCH_MAX_BYTES, ...).
+
+Examples:
+    python backfill.py --bucket <trail-bucket> --account 123456789012 --start 2025-08-01 --end 2025-08-03
+    python backfill.py --bucket <trail-bucket> --prefix AWSLogs/123456789012/CloudTrail/us-east-1/2025/08/01/ --max-mb-per-second 5
+"""
+import os
+import sys
+import json
+import boto3
+import argparse
+import multiprocessing
+from time import time, sleep
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+def ship_object(bucket_name, object_key, etag):
+    # Imported in the worker so every process builds its own S3 client and HTTP session
+    import main
+    records_before = main.shipper.records_sent
+    try:
+        success = main.process_object(bucket_name, object_key, etag, os.getenv("STREAM_DECODE", "True") == "True")
+    except Exception as e:
+        print(f"ERROR :: Failed processing 's3://{bucket_name}/{object_key}' - {e}")
+        success = False
+    return success, main.shipper.records_sent - records_before
+
+
+class Checkpoint:
+    """
+    Append-only file of the keys already shipped, so an interrupted run can be resumed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.keys = set()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.keys = {line.strip() for line in f if line.strip()}
+        self.file = open(path, "a") if path else None
+
+    def __contains__(self, object_key):
+        return object_key in self.keys
+
+    def add(self, object_key):
+        self.keys.add(object_key)
+        if self.file:
+            self.file.write(object_key + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class RateLimiter:
+    """
+    Token bucket allowing 'rate' units per second with up to one second of burst.
+    A rate of 0 disables the limit.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time()
+
+    def acquire(self, amount=1):
+        if not self.rate:
+            return
+        while True:
+            now = time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Amounts larger than the bucket go through once it is full and leave it in debt
+            if self.tokens >= min(amount, self.rate):
+                self.tokens -= amount
+                return
+            sleep((min(amount, self.rate) - self.tokens) / self.rate)
+
+
+class Throughput:
+    def __init__(self):
+        self.started = time()
+        self.objects = 0
+        self.failed = 0
+        self.skipped = 0
+        self.records = 0
+        self.bytes = 0
+
+    def add(self, success, records, size):
+        if success:
+            self.objects += 1
+            self.records += records
+            self.bytes += size
+        else:
+            self.failed += 1
+
+    def report(self, prefix="INFO :: Progress"):
+        elapsed = max(time() - self.started, 0.001)
+        print(f"{prefix} - {self.objects} objects shipped, {self.failed} failed, {self.skipped} skipped from checkpoint | "
+              f"{self.objects / elapsed:.2f} objects/sec, {self.records / elapsed:.0f} records/sec, "
+              f"{self.bytes / elapsed / 1024 / 1024:.2f} MB/sec")
+
+
+def get_prefixes(s3_client, bucket_name, account_id, regions, start, end):
+    """
+    Builds the 'AWSLogs/<account>/CloudTrail/<region>/YYYY/MM/DD/' prefixes of the time range,
+    listing the regions present in the bucket when none are given.
+    """
+    base_prefix = f"AWSLogs/{account_id}/CloudTrail/"
+    if not regions:
+        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=base_prefix, Delimiter="/")
+        regions = [prefix["Prefix"][len(base_prefix):].strip("/") for prefix in response.get("CommonPrefixes", [])]
+
+    prefixes = []
+    for region in regions:
+        day = start
+        while day <= end:
+            prefixes.append(f"{base_prefix}{region}/{day:%Y/%m/%d}/")
+            day += timedelta(days=1)
+    return prefixes
+
+
+def list_objects(s3_client, bucket_name, prefixes):
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for prefix in prefixes:
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for item in page.get("Contents", []):
+                if item["Key"].endswith(".json.gz"):
+                    yield item
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Re-ship CloudTrail objects from the trail bucket to Observe")
+    parser.add_argument("--bucket", required=True, help="CloudTrail bucket name")
+    parser.add_argument("--prefix", help="Explicit key prefix to replay (overrides --account/--start/--end)")
+    parser.add_argument("--account", help="Account ID under AWSLogs/")
+    parser.add_argument("--regions", help="Comma separated regions, all regions found in the bucket by default")
+    parser.add_argument("--start", type=date.fromisoformat, help="First day to replay (YYYY-MM-DD)")
+    parser.add_argument("--end", type=date.fromisoformat, help="Last day to replay (YYYY-MM-DD), defaults to --start")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="Number of worker processes")
+    parser.add_argument("--checkpoint", default="backfill.checkpoint", help="File recording shipped keys, used to resume")
+    parser.add_argument("--max-objects-per-second", type=float, default=0, help="Rate limit on dispatched objects")
+    parser.add_argument("--max-mb-per-second", type=float, default=0, help="Rate limit on dispatched (compressed) MB")
+    parser.add_argument("--report-interval", type=int, default=30, help="Seconds between progress reports")
+    parser.add_argument("--ignore-shipped", action="store_true", help="Re-ship objects the idempotency table marks as shipped")
+    args = parser.parse_args(argv)
+    if not args.prefix and not (args.account and args.start):
+        parser.error("either --prefix or --account and --start are required")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.ignore_shipped:
+        # Inherited by the worker processes before they build their tracker
+        os.environ["IDEMPOTENCY_TABLE"] = ""
+
+    s3_client = boto3.client("s3")
+    if args.prefix:
+        prefixes = [args.prefix]
+    else:
+        regions = args.regions.split(",") if args.regions else None
+        prefixes = get_prefixes(s3_client, args.bucket, args.account, regions, args.start, args.end or args.start)
+
+    checkpoint = Checkpoint(args.checkpoint)
+    object_limiter = RateLimiter(args.max_objects_per_second)
+    byte_limiter = RateLimiter(args.max_mb_per_second * 1024 * 1024)
+    throughput = Throughput()
+    last_report = time()
+
+    def collect(futures):
+        for future in futures:
+            item = in_flight.pop(future)
+            success, records = future.result()
+            throughput.add(success, records, item["Size"])
+            if success:
+                checkpoint.add(item["Key"])
+
+    in_flight = {}
+    # Spawned workers do not inherit clients or connection pools from this process
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for item in list_objects(s3_client, args.bucket, prefixes):
+            if item["Key"] in checkpoint:
+                throughput.skipped += 1
+                continue
+            object_limiter.acquire()
+            byte_limiter.acquire(item["Size"])
+            future = executor.submit(ship_object, args.bucket, item["Key"], item["ETag"])
+            in_flight[future] = item
+
+            if len(in_flight) >= args.workers * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            if time() - last_report >= args.report_interval:
+                throughput.report()
+                last_report = time()
+
+        collect(list(in_flight))
+
+    checkpoint.close()
+    throughput.report("INFO :: Backfill finished")
+    print(json.dumps({
+        "objects": throughput.objects,
+        "failed": throughput.failed,
+        "skipped": throughput.skipped,
+        "records": throughput.records,
+        "bytes": throughput.bytes,
+        "seconds": round(time() - throughput.started, 3)
+    }))
+    return 0 if throughput.failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
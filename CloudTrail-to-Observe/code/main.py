@@ -1,34 +1,284 @@
+import io
 import os
+import re
 import gzip
 import json
 import boto3
-from observe import Observe
+import tempfile
+from itertools import islice
+from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from observe import Observe, CircuitBreaker
+from spool import S3Spool, LocalSpool
+from pipeline import ShippingPipeline
+from record_filter import RecordFilter
+from object_tracker import ObjectTracker, DynamoDBStore
 
+STREAM_CHUNK_SIZE = 64 * 1024
 
-def lambda_handler(event, context):
-    bucket_name = event["Records"][0]["s3"]["bucket"]["name"]
-    object_key = event["Records"][0]["s3"]["object"]["key"]
-    file_path = f"/tmp/cur_log_file.json.gz"
-    file_downloaded = False
-
-    customer_id = os.getenv("CUSTOMER_ID")
-    token = os.getenv("TOKEN")
-    extra = os.getenv("EXTRA")
-    shipper = Observe(customer_id=customer_id, token=token, extra=extra)
-
-    try:
-        s3_client = boto3.client("s3")
-        response = s3_client.download_file(bucket_name, object_key, file_path)
-        file_downloaded = True
-    except Exception as e:
-        print(e)
-
-    if file_downloaded:
+
+class RecordStreamDecoder:
+    """
+    Incremental parser for CloudTrail log documents ({"Records": [...]}).
+    Reads the text stream in chunks and yields the entries of the top level
+    "Records" array one by one, so only the record being decoded and the current
+    read buffer are kept in memory.
+    """
+    whitespace = re.compile(r"[ \t\n\r]*")
+    # A number cut by the buffer edge parses as its shorter prefix, leaving up to "e+" unread
+    edge_margin = 3
+
+    def __init__(self, stream, chunk_size=STREAM_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+        self.bytes_decoded = 0
+
+    def _fill(self):
+        if self.eof:
+            return False
+        # Reading at least as much as is already pending keeps the re-parsing of large records linear
+        chunk = self.stream.read(max(self.chunk_size, len(self.buffer) - self.position))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def _next_char(self):
+        while True:
+            self.position = self.whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                return ""
+
+    def _value(self, raw=False):
+        self._next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            if len(self.buffer) - end < self.edge_margin and not self.eof and self._fill():
+                # A value ending near the buffer edge (e.g. '1.' of '1.5') may continue in the next chunk
+                continue
+            self.bytes_decoded += end - self.position
+            if raw:
+                value = self.buffer[self.position:end].encode("utf-8")
+            self.position = end
+            return value
+
+    def _expect(self, char):
+        if self._next_char() != char:
+            raise ValueError(f"Malformed CloudTrail log - expected '{char}' at offset {self.position}")
+        self.position += 1
+
+    def records(self, raw=False):
+        """
+        Yields each record, or its original JSON text as bytes when 'raw' is set
+        so it can be shipped without being serialized again.
+        """
+        if self._next_char() != "{":
+            return
+        self.position += 1
+        while True:
+            char = self._next_char()
+            if char == "}" or char == "":
+                return
+            if char == ",":
+                self.position += 1
+                continue
+
+            key = self._value()
+            self._expect(":")
+            if key == "Records" and self._next_char() == "[":
+                self.position += 1
+                while True:
+                    char = self._next_char()
+                    if char == "]":
+                        self.position += 1
+                        break
+                    if char == ",":
+                        self.position += 1
+                        continue
+                    if char == "":
+                        raise ValueError("Malformed CloudTrail log - unexpected end of 'Records'")
+                    yield self._value(raw)
+            else:
+                self._value()
+
+
+def decode_records(compressed_stream):
+    with gzip.GzipFile(fileobj=compressed_stream) as compressed:
+        with io.TextIOWrapper(compressed, encoding="utf-8") as text:
+            decoder = RecordStreamDecoder(text)
+            try:
+                yield from record_filter.apply(decoder.records(raw=record_filter.passthrough))
+            finally:
+                record_filter.add_bytes_in(decoder.bytes_decoded)
+
+
+def create_spool():
+    if os.getenv("SPOOL_BUCKET"):
+        return S3Spool(s3_client, os.getenv("SPOOL_BUCKET"), os.getenv("SPOOL_PREFIX", "observe-spool/"))
+    if os.getenv("SPOOL_DIR"):
+        return LocalSpool(os.getenv("SPOOL_DIR"), int(os.getenv("SPOOL_MAX_BYTES", 256 * 1024 * 1024)))
+    return None
+
+
+def create_shipper():
+    return Observe(
+        customer_id=os.getenv("CUSTOMER_ID"),
+        token=os.getenv("TOKEN"),
+        extra=os.getenv("EXTRA"),
+        max_batch_bytes=int(os.getenv("BATCH_MAX_BYTES", 4000000)),
+        max_batch_records=int(os.getenv("BATCH_MAX_RECORDS", 10000)),
+        pool_size=int(os.getenv("HTTP_POOL_SIZE", 10)),
+        data_type=os.getenv("OUTPUT_FORMAT", "json"),
+        connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", 3)),
+        read_timeout=float(os.getenv("HTTP_READ_TIMEOUT", 15)),
+        max_retries=int(os.getenv("HTTP_MAX_RETRIES", 3)),
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5)),
+            reset_timeout=float(os.getenv("BREAKER_RESET_TIMEOUT", 30))
+        ),
+        spool=create_spool()
+    )
+
+
+def create_tracker():
+    store = None
+    table_name = os.getenv("IDEMPOTENCY_TABLE")
+    if table_name:
+        # DYNAMODB_ENDPOINT_URL allows pointing the store to DynamoDB Local
+        dynamodb_client = boto3.client("dynamodb", endpoint_url=os.getenv("DYNAMODB_ENDPOINT_URL") or None)
+        store = DynamoDBStore(dynamodb_client, table_name)
+    return ObjectTracker(store, lru_size=int(os.getenv("IDEMPOTENCY_LRU_SIZE", 1024)))
+
+
+# Created once per execution environment and reused by warm invocations
+s3_client = boto3.client("s3")
+shipper = create_shipper()
+record_filter = RecordFilter(json.loads(os.getenv("FILTER_RULES") or "{}"))
+tracker = create_tracker()
+pipeline = ShippingPipeline(
+    shipper,
+    decode_records,
+    uploaders=int(os.getenv("PIPELINE_UPLOADERS", 2)),
+    queue_size=int(os.getenv("PIPELINE_QUEUE_SIZE", 4)),
+    read_chunk_size=int(os.getenv("S3_READ_CHUNK_SIZE", 1024 * 1024))
+)
+
+
+def get_s3_objects(event):
+    """
+    Returns (message_id, bucket, key, etag) for every object in the event, supporting both
+    direct S3 notifications and S3 notifications delivered through SQS.
+    'message_id' is only set for SQS records so failed messages can be reported back.
+    """
+    objects = []
+    for record in event.get("Records", []):
+        if "s3" in record:
+            objects.append((None, *get_s3_object(record["s3"])))
+        elif "body" in record:
+            body = json.loads(record["body"])
+            for s3_record in body.get("Records", []):
+                if "s3" in s3_record:
+                    objects.append((record["messageId"], *get_s3_object(s3_record["s3"])))
+    return objects
+
+
+def get_s3_object(s3_entity):
+    return s3_entity["bucket"]["name"], unquote_plus(s3_entity["object"]["key"]), s3_entity["object"].get("eTag")
+
+
+def process_object(bucket_name, object_key, etag=None, stream_decode=True):
+    if not etag:
+        etag = s3_client.head_object(Bucket=bucket_name, Key=object_key)["ETag"]
+    object_id = tracker.object_id(bucket_name, object_key, etag)
+    if tracker.is_complete(object_id):
+        print(f"INFO :: 's3://{bucket_name}/{object_key}' was already shipped - skipping")
+        return True
+
+    progress = tracker.progress(object_id)
+    if progress.records_acked > 0:
+        print(f"INFO :: Resuming 's3://{bucket_name}/{object_key}' after {progress.records_acked} acknowledged records")
+
+    if stream_decode:
+        response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
+        success = pipeline.run(response["Body"], progress)
+    else:
+        success = download_and_ship(bucket_name, object_key, progress)
+
+    if success:
+        progress.complete()
+    return success
+
+
+def download_and_ship(bucket_name, object_key, progress):
+    # Each object gets its own scratch directory so concurrent downloads never share a file
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        file_path = os.path.join(scratch_dir, "cur_log_file.json.gz")
+        s3_client.download_file(bucket_name, object_key, file_path)
         with gzip.open(file_path, 'rt', encoding='utf-8') as f:
-            file_content = json.load(f)
-            if "Records" in file_content:
-                try:
-                    shipper.send_bulk(file_content["Records"])
-                except Exception as e:
-                    print(e)
+            file_text = f.read()
+        record_filter.add_bytes_in(len(file_text))
+        file_content = json.loads(file_text)
+        del file_text
+
+    success = True
+    records = islice(record_filter.apply(file_content.get("Records", [])), progress.records_acked, None)
+    for sequence, (payload, record_count) in enumerate(shipper.build_batches(records)):
+        if shipper.post_batch(payload, record_count):
+            progress.ack(sequence, record_count)
+        else:
+            success = False
+    return success
+
+
+def lambda_handler(event, context):
+    stream_decode = os.getenv("STREAM_DECODE", "True") == "True"
+    max_workers = int(os.getenv("MAX_WORKERS", 4))
+    objects = get_s3_objects(event)
+    results = []
+
+    replayed = shipper.replay_spool(int(os.getenv("SPOOL_REPLAY_MAX", 20)))
+    if replayed > 0:
+        print(f"INFO :: Replayed {replayed} spooled batches")
+
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(objects)), 1)) as executor:
+        futures = {
+            executor.submit(process_object, bucket_name, object_key, etag, stream_decode): (message_id, bucket_name, object_key)
+            for message_id, bucket_name, object_key, etag in objects
+        }
+        for future in as_completed(futures):
+            message_id, bucket_name, object_key = futures[future]
+            try:
+                success = future.result()
+            except Exception as e:
+                print(f"ERROR :: Failed processing 's3://{bucket_name}/{object_key}' - {e}")
+                success = False
+            results.append({"message_id": message_id, "bucket": bucket_name, "key": object_key, "success": success})
+
+    failed_message_ids = {result["message_id"] for result in results if not result["success"] and result["message_id"]}
+    print(f"INFO :: Processed {len(results)} objects, {len([r for r in results if not r['success']])} failed")
+    shipper_stats = shipper.connection_stats()
+    print(f"INFO :: Observe shipper stats since cold start - {shipper_stats}")
+    print(f"INFO :: Record filter stats since cold start - {record_filter.stats(shipper_stats['bytes_serialized'])}")
 
+    # Direct S3 notifications are asynchronous and have no batchItemFailures, failing the
+    # invocation makes Lambda retry the event and the tracker skips the objects already shipped
+    failed_direct = [result["key"] for result in results if not result["success"] and not result["message_id"]]
+    if failed_direct:
+        raise RuntimeError(f"Failed shipping {len(failed_direct)} objects - {failed_direct}")
+    return {
+        "results": results,
+        "batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_message_ids]
+    }
@@ -0,0 +1,141 @@
+import threading
+from time import time
+from collections import OrderedDict
+
+STATUS_PARTIAL = "partial"
+STATUS_COMPLETE = "complete"
+
+
+class MemoryStore:
+    """
+    In-process LRU store, used on its own when no durable store is configured
+    and as the front cache of ObjectTracker.
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, object_id):
+        with self.lock:
+            state = self.items.get(object_id)
+            if state is not None:
+                self.items.move_to_end(object_id)
+            return state
+
+    def put(self, object_id, state):
+        with self.lock:
+            self.items[object_id] = state
+            self.items.move_to_end(object_id)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+
+class DynamoDBStore:
+    """
+    Durable store on a DynamoDB table with an 'object_id' string hash key.
+    The client can point to DynamoDB Local (endpoint_url) to run without AWS.
+    A complete object is never downgraded back to partial by a concurrent run.
+    """
+    def __init__(self, client, table_name, ttl_seconds=7 * 24 * 3600):
+        self.client = client
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, object_id):
+        response = self.client.get_item(
+            TableName=self.table_name,
+            Key={"object_id": {"S": object_id}},
+            ConsistentRead=True
+        )
+        item = response.get("Item")
+        if not item:
+            return None
+        return {"status": item["status"]["S"], "records_acked": int(item["records_acked"]["N"])}
+
+    def put(self, object_id, state):
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={
+                    "object_id": {"S": object_id},
+                    "status": {"S": state["status"]},
+                    "records_acked": {"N": str(state["records_acked"])},
+                    "expires_at": {"N": str(int(time()) + self.ttl_seconds)}
+                },
+                ConditionExpression="attribute_not_exists(object_id) OR #status <> :complete",
+                ExpressionAttributeNames={"#status": "status"},
+                ExpressionAttributeValues={":complete": {"S": STATUS_COMPLETE}}
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+
+class ObjectTracker:
+    """
+    Tracks shipping state per S3 object version (bucket/key/ETag) so redelivered
+    notifications skip objects already shipped and resume partially shipped ones.
+    """
+    def __init__(self, store=None, lru_size=1024):
+        self.store = store
+        self.cache = MemoryStore(lru_size)
+
+    @staticmethod
+    def object_id(bucket_name, object_key, etag):
+        etag = etag.strip('"')
+        return f"{bucket_name}/{object_key}#{etag}"
+
+    def get(self, object_id):
+        state = self.cache.get(object_id)
+        if state is None and self.store:
+            state = self.store.get(object_id)
+            if state is not None:
+                self.cache.put(object_id, state)
+        return state
+
+    def put(self, object_id, status, records_acked):
+        state = {"status": status, "records_acked": records_acked}
+        self.cache.put(object_id, state)
+        if self.store:
+            try:
+                self.store.put(object_id, state)
+            except Exception as e:
+                # Checkpoints are best effort, a lost one only means more records are re-shipped on resume
+                print(f"WARNING :: Failed checkpointing '{object_id}' - {e}")
+
+    def progress(self, object_id):
+        state = self.get(object_id) or {}
+        return ShippingProgress(self, object_id, state.get("records_acked", 0))
+
+    def is_complete(self, object_id):
+        state = self.get(object_id)
+        return state is not None and state["status"] == STATUS_COMPLETE
+
+
+class ShippingProgress:
+    """
+    Turns out-of-order batch acknowledgements from concurrent uploaders into a
+    contiguous watermark of acknowledged records, checkpointed on every advance.
+    'records_acked' is also the number of records to skip when resuming.
+    """
+    def __init__(self, tracker, object_id, records_acked=0):
+        self.tracker = tracker
+        self.object_id = object_id
+        self.records_acked = records_acked
+        self.next_sequence = 0
+        self.acked_batches = {}
+        self.lock = threading.Lock()
+
+    def ack(self, sequence, record_count):
+        with self.lock:
+            self.acked_batches[sequence] = record_count
+            advanced = False
+            while self.next_sequence in self.acked_batches:
+                self.records_acked += self.acked_batches.pop(self.next_sequence)
+                self.next_sequence += 1
+                advanced = True
+            if advanced:
+                self.tracker.put(self.object_id, STATUS_PARTIAL, self.records_acked)
+
+    def complete(self):
+        self.tracker.put(self.object_id, STATUS_COMPLETE, self.records_acked)
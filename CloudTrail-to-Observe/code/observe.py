@@ -1,42 +1,260 @@
+import gzip
+import json
+import random
 import requests
+import threading
+from time import time, sleep
+from requests.adapters import HTTPAdapter
+
+try:
+    # Optional faster encoder, used when shipped in the Lambda layer
+    import orjson
+except ImportError:
+    orjson = None
+
+CONTENT_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson"
+}
+
+DELIVERY_SENT = "sent"
+DELIVERY_REJECTED = "rejected"
+DELIVERY_FAILED = "failed"
+
+
+def encode_record(record):
+    if orjson:
+        return orjson.dumps(record)
+    return json.dumps(record, separators=(",", ":")).encode("utf-8")
+
+
+def create_session(pool_size=10):
+    """
+    Keep-alive session with a connection pool sized for the number of concurrent uploads.
+    Kept alive on the shipper so warm invocations skip the TCP/TLS handshake.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class CircuitBreaker:
+    """
+    Opens after 'failure_threshold' consecutive failed requests and rejects requests
+    for 'reset_timeout' seconds, after which a trial request is let through.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time() - self.opened_at >= self.reset_timeout:
+                # Half open - the next failure re-opens the breaker for another period
+                self.opened_at = None
+                self.failures = self.failure_threshold - 1
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold and self.opened_at is None:
+                self.opened_at = time()
+                print(f"WARNING :: Observe circuit breaker opened for {self.reset_timeout} seconds")
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None and time() - self.opened_at < self.reset_timeout
 
 
 class Observe:
-    def __init__(self, customer_id, token, region="eu-1", extra=None):
+    def __init__(self, customer_id, token, region="eu-1", extra=None, max_batch_bytes=4000000, max_batch_records=10000,
+                 pool_size=10, session=None, data_type="json", connect_timeout=3, read_timeout=15, max_retries=3,
+                 backoff_base=0.5, backoff_cap=8, breaker=None, spool=None):
         self.logs_endpoint = f"https://{customer_id}.collect.{region}.observeinc.com/v1/http"#?customer=ciso_prod&origin=python&logType=stale_resources"
         self.extra = extra
         self.token = token
-        self.added_extra = False
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_records = max_batch_records
+        self.data_type = data_type
+        self.session = session if session else create_session(pool_size)
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.breaker = breaker if breaker else CircuitBreaker()
+        self.spool = spool
+        self.records_sent = 0
+        self.bytes_sent = 0
+        self.bytes_serialized = 0
+        self.requests_sent = 0
+        self.retries = 0
+        self.batches_spooled = 0
+        self.lock = threading.Lock()
+
+        if self.extra and len(self.extra) > 0:
+            endpoint_extra = []
+            for item in self.extra.split(","):
+                k, v = item.split(":")
+                endpoint_extra.append(f"{k}={v}")
+            self.logs_endpoint += "?" + "&".join(endpoint_extra)
 
     @staticmethod
     def get_name():
         return "Observe"
 
-    def send_bulk(self, data, data_type="json"):
+    def build_batches(self, records, data_type=None):
+        """
+        Serializes each record once and groups them into payloads bounded by
+        'max_batch_bytes' (uncompressed) and 'max_batch_records' - a JSON array for
+        'json' or one record per line for 'ndjson'. Records given as bytes are
+        treated as already encoded JSON and passed through as is.
+        Yields tuples of (gzip compressed payload, number of records in it).
+        """
+        data_type = data_type or self.data_type
+        parts = []
+        size = 2
+        for record in records:
+            encoded = record if type(record) is bytes else encode_record(record)
+            if data_type == "ndjson" and b"\n" in encoded:
+                encoded = encode_record(json.loads(encoded))
+            if parts and (size + len(encoded) + 1 > self.max_batch_bytes or len(parts) >= self.max_batch_records):
+                self.add_serialized(size)
+                yield self.compress_batch(parts, data_type), len(parts)
+                parts = []
+                size = 2
+            parts.append(encoded)
+            size += len(encoded) + 1
+        if parts:
+            self.add_serialized(size)
+            yield self.compress_batch(parts, data_type), len(parts)
+
+    def add_serialized(self, size):
+        with self.lock:
+            self.bytes_serialized += size
+
+    @staticmethod
+    def compress_batch(parts, data_type="json"):
+        if data_type == "ndjson":
+            return gzip.compress(b"\n".join(parts) + b"\n", compresslevel=6)
+        return gzip.compress(b"[" + b",".join(parts) + b"]", compresslevel=6)
+
+    def connection_stats(self):
+        """
+        Reports how many HTTP requests reused an already open connection,
+        based on the counters of the urllib3 pools behind the session.
+        """
+        connections_opened = 0
+        pool_requests = 0
+        pools = self.session.get_adapter(self.logs_endpoint).poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            connections_opened += pool.num_connections
+            pool_requests += pool.num_requests
+        return {
+            "requests_sent": self.requests_sent,
+            "records_sent": self.records_sent,
+            "bytes_sent": self.bytes_sent,
+            "bytes_serialized": self.bytes_serialized,
+            "retries": self.retries,
+            "batches_spooled": self.batches_spooled,
+            "connections_opened": connections_opened,
+            "connections_reused": max(pool_requests - connections_opened, 0)
+        }
+
+    def post_batch(self, payload, record_count, data_type=None, spool=True):
+        """
+        Posts one batch, see deliver. A batch that still fails for a retryable reason is
+        written to the spool when one is configured, in which case it counts as handled
+        and is replayed by a later invocation. Batches the collector rejects are never
+        spooled, replaying them would fail the same way.
+        """
+        data_type = data_type or self.data_type
+        outcome = self.deliver(payload, record_count, data_type)
+        if outcome == DELIVERY_SENT:
+            return True
+        if outcome == DELIVERY_FAILED and spool and self.spool and self.spool.put(payload, record_count, data_type):
+            with self.lock:
+                self.batches_spooled += 1
+            return True
+        return False
+
+    def deliver(self, payload, record_count, data_type):
+        """
+        Posts one batch with connect/read timeouts, retrying connection errors, 429 and 5xx
+        responses with jittered exponential backoff while the circuit breaker allows it.
+        Returns DELIVERY_SENT, DELIVERY_REJECTED (a 4xx other than 429) or DELIVERY_FAILED.
+        """
         headers = {
-            "Content-Type": f"application/{data_type}",
+            "Content-Type": CONTENT_TYPES[data_type],
+            "Content-Encoding": "gzip",
             "Authorization": f"Bearer {self.token}"
         }
-        if data_type == "json":
-            if type(data) is list or type(data) is dict:
-                if self.extra and len(self.extra) > 0 and not self.added_extra:
-                    extra_array = self.extra.split(",")
-                    self.logs_endpoint = self.logs_endpoint + "?"
-                    endpoint_extra = ""
-                    for item in extra_array:
-                        k, v = item.split(":")
-                        if len(endpoint_extra) == 0:
-                            endpoint_extra += f"{k}={v}"
-                        else:
-                            endpoint_extra += f"&{k}={v}"
-                    self.added_extra = True
-                    self.logs_endpoint += endpoint_extra
-                try:
-                    # print(self.logs_endpoint)
-                    requests.post(self.logs_endpoint, headers=headers, json=data)
-                except Exception as e:
-                    print(f"ERROR :: {e}")
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                print("WARNING :: Observe circuit breaker is open - not sending batch")
+                break
+            if attempt > 0:
+                with self.lock:
+                    self.retries += 1
+            try:
+                # print(self.logs_endpoint)
+                response = self.session.post(self.logs_endpoint, headers=headers, data=payload, timeout=self.timeout)
+                response.raise_for_status()
+                self.breaker.record_success()
+                with self.lock:
+                    self.records_sent += record_count
+                    self.bytes_sent += len(payload)
+                    self.requests_sent += 1
+                return DELIVERY_SENT
+            except requests.HTTPError as e:
+                print(f"ERROR :: {e}")
+                if e.response.status_code != 429 and e.response.status_code < 500:
+                    # The collector is reachable but rejects the batch, retrying will not help
+                    return DELIVERY_REJECTED
+                self.breaker.record_failure()
+            except Exception as e:
+                print(f"ERROR :: {e}")
+                self.breaker.record_failure()
+            if attempt < self.max_retries:
+                sleep(random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt)))
+        return DELIVERY_FAILED
+
+    def replay_spool(self, limit=20):
+        if not self.spool or self.breaker.is_open:
+            return 0
+        try:
+            return self.spool.replay(self, limit)
+        except Exception as e:
+            print(f"ERROR :: Failed replaying spooled batches - {e}")
+            return 0
+
+    def send_bulk(self, data, data_type=None):
+        data_type = data_type or self.data_type
+        if data_type in CONTENT_TYPES:
+            if type(data) is dict:
+                data = [data]
+            if type(data) is not str and hasattr(data, "__iter__"):
+                all_sent = True
+                for payload, record_count in self.build_batches(data, data_type):
+                    if not self.post_batch(payload, record_count, data_type):
+                        all_sent = False
+                return all_sent
             else:
                 print("ERROR :: Unknown data received")
         else:
             print("ERROR :: Unknown data type")
+        return False
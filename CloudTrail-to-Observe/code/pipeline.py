@@ -0,0 +1,131 @@
+import io
+import queue
+import threading
+from itertools import islice
+
+END_OF_STREAM = object()
+
+
+def put_until_stopped(target_queue, item, stop):
+    """
+    Blocking put that gives up once 'stop' is set, so a stage never hangs
+    on a full queue after the stage consuming it has failed.
+    """
+    while not stop.is_set():
+        try:
+            target_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class QueueStream(io.RawIOBase):
+    """
+    Read-only file object over the byte chunks produced by the reader stage.
+    An exception put in the queue is raised to the reading stage.
+    """
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = chunks
+        self.pending = b""
+        self.offset = 0
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset >= len(self.pending) and not self.done:
+            chunk = self.chunks.get()
+            if chunk is END_OF_STREAM:
+                self.done = True
+            elif isinstance(chunk, Exception):
+                self.done = True
+                raise chunk
+            else:
+                self.pending = chunk
+                self.offset = 0
+        size = min(len(buffer), len(self.pending) - self.offset)
+        buffer[:size] = self.pending[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+
+class ShippingPipeline:
+    """
+    Ships one S3 object through three stages connected by bounded queues:
+    a reader streaming the object body, the decoder (gunzip + parse + batching)
+    running in the calling thread, and 'uploaders' threads posting batches to
+    the shipper. The bounded queues apply backpressure, so memory stays at
+    roughly 'queue_size' read chunks plus 'queue_size' batches per object.
+    """
+    def __init__(self, shipper, decode, uploaders=2, queue_size=4, read_chunk_size=1024 * 1024):
+        self.shipper = shipper
+        self.decode = decode
+        self.uploaders = uploaders
+        self.queue_size = queue_size
+        self.read_chunk_size = read_chunk_size
+
+    def read_stage(self, body, chunks, stop):
+        try:
+            for chunk in body.iter_chunks(self.read_chunk_size):
+                if not put_until_stopped(chunks, chunk, stop):
+                    return
+            put_until_stopped(chunks, END_OF_STREAM, stop)
+        except Exception as e:
+            put_until_stopped(chunks, e, stop)
+        finally:
+            body.close()
+
+    def upload_stage(self, batches, failures, progress):
+        while True:
+            batch = batches.get()
+            if batch is END_OF_STREAM:
+                return
+            sequence, (payload, record_count) = batch
+            # An uploader must outlive any error, the decoder blocks on the queue while none is draining it
+            try:
+                if self.shipper.post_batch(payload, record_count):
+                    if progress:
+                        progress.ack(sequence, record_count)
+                else:
+                    failures.append(record_count)
+            except Exception as e:
+                print(f"ERROR :: Failed uploading batch of {record_count} records - {e}")
+                failures.append(record_count)
+
+    def run(self, body, progress=None):
+        """
+        Ships the object body and returns True if every batch was accepted.
+        With a ShippingProgress, records acknowledged by a previous attempt are
+        skipped and each accepted batch is acknowledged to it.
+        """
+        chunks = queue.Queue(maxsize=self.queue_size)
+        batches = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        failures = []
+
+        reader = threading.Thread(target=self.read_stage, args=(body, chunks, stop), daemon=True)
+        uploaders = [threading.Thread(target=self.upload_stage, args=(batches, failures, progress), daemon=True)
+                     for _ in range(self.uploaders)]
+        reader.start()
+        for uploader in uploaders:
+            uploader.start()
+
+        try:
+            records = self.decode(QueueStream(chunks))
+            if progress and progress.records_acked > 0:
+                records = islice(records, progress.records_acked, None)
+            for batch in enumerate(self.shipper.build_batches(records)):
+                batches.put(batch)
+        finally:
+            # Uploaders drain what was already decoded before exiting, the reader is stopped if still running
+            for _ in uploaders:
+                batches.put(END_OF_STREAM)
+            for uploader in uploaders:
+                uploader.join()
+            stop.set()
+            reader.join()
+
+        return len(failures) == 0
@@ -0,0 +1,141 @@
+import re
+import zlib
+import fnmatch
+import threading
+
+MISSING = object()
+
+
+def get_path(record, path):
+    value = record
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return MISSING
+        value = value[key]
+    return value
+
+
+def set_path(record, path, value):
+    for key in path[:-1]:
+        record = record.setdefault(key, {})
+    record[path[-1]] = value
+
+
+def compile_condition(field, expected):
+    """
+    Compiles a single '<dotted.path>: value(s)' condition into a predicate.
+    Strings are glob patterns (e.g. 'Describe*') merged into one regex, any
+    other value (booleans such as readOnly) is compared as is.
+    """
+    path = tuple(field.split("."))
+    values = expected if isinstance(expected, list) else [expected]
+    patterns = [value for value in values if isinstance(value, str)]
+    exact_values = [value for value in values if not isinstance(value, str)]
+    regex = re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns)) if patterns else None
+
+    def condition(record):
+        value = get_path(record, path)
+        if regex and isinstance(value, str):
+            return regex.match(value) is not None
+        return any(type(value) is type(exact) and value == exact for exact in exact_values)
+    return condition
+
+
+def compile_rule(rule):
+    """
+    Returns (predicate, sample_rate) for a rule such as
+    {"action": "deny", "match": {"eventName": ["Describe*", "List*"], "readOnly": true}, "sample_rate": 0.01}
+    'sample_rate' is the share of matching records that is shipped, by default 1 for allow and 0 for deny.
+    """
+    conditions = [compile_condition(field, expected) for field, expected in rule.get("match", {}).items()]
+    default_rate = 1.0 if rule.get("action", "allow") == "allow" else 0.0
+    sample_rate = float(rule.get("sample_rate", default_rate))
+
+    def predicate(record):
+        return all(condition(record) for condition in conditions)
+    return predicate, sample_rate
+
+
+class RecordFilter:
+    """
+    Declarative filter and projection applied to records before shipping.
+    Configuration (compiled once, typically from the FILTER_RULES env variable):
+        {
+            "rules": [{"action": "allow|deny", "match": {"<path>": <value(s)>}, "sample_rate": <0..1>}, ...],
+            "default_action": "allow|deny",
+            "keep_fields": ["<path>", ...],
+            "drop_fields": ["<path>", ...]
+        }
+    The first matching rule decides, records matching no rule follow 'default_action'.
+    Sampling is keyed on the eventID so a redelivered object is filtered identically.
+    """
+    def __init__(self, config=None):
+        config = config or {}
+        self.rules = [compile_rule(rule) for rule in config.get("rules", [])]
+        self.default_rate = 1.0 if config.get("default_action", "allow") == "allow" else 0.0
+        self.keep_fields = [tuple(field.split(".")) for field in config.get("keep_fields", [])]
+        self.drop_fields = [tuple(field.split(".")) for field in config.get("drop_fields", [])]
+        # Without rules or projections records can be shipped in their original encoding
+        self.passthrough = not (self.rules or self.keep_fields or self.drop_fields or self.default_rate < 1)
+        self.lock = threading.Lock()
+        self.records_in = 0
+        self.records_kept = 0
+        self.bytes_in = 0
+
+    @staticmethod
+    def sampled(record, sample_rate):
+        if sample_rate >= 1:
+            return True
+        if sample_rate <= 0:
+            return False
+        key = str(record.get("eventID", record.get("eventTime", ""))).encode("utf-8")
+        return zlib.crc32(key) % 10000 < sample_rate * 10000
+
+    def should_ship(self, record):
+        for predicate, sample_rate in self.rules:
+            if predicate(record):
+                return self.sampled(record, sample_rate)
+        return self.sampled(record, self.default_rate)
+
+    def project(self, record):
+        if self.keep_fields:
+            projected = {}
+            for path in self.keep_fields:
+                value = get_path(record, path)
+                if value is not MISSING:
+                    set_path(projected, path, value)
+            record = projected
+        for path in self.drop_fields:
+            parent = get_path(record, path[:-1])
+            if isinstance(parent, dict):
+                parent.pop(path[-1], None)
+        return record
+
+    def apply(self, records):
+        records_in = 0
+        records_kept = 0
+        try:
+            for record in records:
+                records_in += 1
+                if not isinstance(record, dict) or self.should_ship(record):
+                    records_kept += 1
+                    yield self.project(record) if isinstance(record, dict) else record
+        finally:
+            with self.lock:
+                self.records_in += records_in
+                self.records_kept += records_kept
+
+    def add_bytes_in(self, size):
+        with self.lock:
+            self.bytes_in += size
+
+    def stats(self, bytes_out=None):
+        stats = {
+            "records_in": self.records_in,
+            "records_kept": self.records_kept,
+            "records_dropped": self.records_in - self.records_kept,
+            "bytes_in": self.bytes_in
+        }
+        if bytes_out is not None and self.bytes_in > 0:
+            stats["byte_reduction"] = round(1 - bytes_out / self.bytes_in, 4)
+        return stats
@@ -0,0 +1,175 @@
+import os
+import threading
+from time import time
+from uuid import uuid4
+from botocore.exceptions import ClientError
+from observe import DELIVERY_SENT, DELIVERY_REJECTED
+
+
+def spool_name(record_count, data_type):
+    return f"{int(time() * 1000)}-{uuid4().hex}-{record_count}.{data_type}.gz"
+
+
+def parse_spool_name(name):
+    """
+    Returns (record_count, data_type) from a name created by spool_name.
+    """
+    stem, data_type, _ = name.rsplit("/", 1)[-1].rsplit(".", 2)
+    return int(stem.rsplit("-", 1)[-1]), data_type
+
+
+class S3Spool:
+    """
+    Durable spool of gzip compressed batches the collector did not accept, stored
+    under 'prefix' of a dedicated bucket (never the trail bucket, which notifies
+    this function on every object). Size is bounded by the bucket lifecycle rule.
+    Concurrent invocations replay the same spool, each batch is claimed with a
+    conditional write before it is posted so only one of them sends it.
+    """
+    def __init__(self, s3_client, bucket_name, prefix="observe-spool/", claim_timeout=900):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.claim_prefix = prefix.rstrip("/") + "-claims/"
+        self.rejected_prefix = prefix.rstrip("/") + "-rejected/"
+        self.claim_timeout = claim_timeout
+
+    def put(self, payload, record_count, data_type):
+        key = self.prefix + spool_name(record_count, data_type)
+        try:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=payload)
+            print(f"WARNING :: Spooled {record_count} records to 's3://{self.bucket_name}/{key}'")
+            return True
+        except Exception as e:
+            print(f"ERROR :: Failed spooling batch - {e}")
+            return False
+
+    def claim(self, key):
+        """
+        Returns the claim marker key once this invocation owns the batch, None when
+        another one does. A claim older than 'claim_timeout' (its invocation died
+        mid replay) is taken over.
+        """
+        claim_key = self.claim_prefix + key[len(self.prefix):]
+        try:
+            # A unique body gives every claim its own ETag for the takeover below
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=claim_key, Body=uuid4().bytes, IfNoneMatch="*")
+            return claim_key
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise
+        try:
+            head = self.s3_client.head_object(Bucket=self.bucket_name, Key=claim_key)
+        except ClientError as e:
+            # The holder released its claim meanwhile, the batch is left to the next replay
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        if time() - head["LastModified"].timestamp() < self.claim_timeout:
+            return None
+        try:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=claim_key, Body=uuid4().bytes, IfMatch=head["ETag"])
+            return claim_key
+        except ClientError:
+            return None
+
+    def replay(self, shipper, limit):
+        replayed = 0
+        response = self.s3_client.list_objects_v2(Bucket=self.bucket_name, Prefix=self.prefix, MaxKeys=limit)
+        for item in response.get("Contents", []):
+            claim_key = self.claim(item["Key"])
+            if not claim_key:
+                continue
+            try:
+                record_count, data_type = parse_spool_name(item["Key"])
+                payload = self.s3_client.get_object(Bucket=self.bucket_name, Key=item["Key"])["Body"].read()
+                outcome = shipper.deliver(payload, record_count, data_type)
+                if outcome == DELIVERY_SENT:
+                    self.s3_client.delete_object(Bucket=self.bucket_name, Key=item["Key"])
+                    replayed += 1
+                elif outcome == DELIVERY_REJECTED:
+                    # Moved aside so it does not hold up the batches behind it
+                    rejected_key = self.rejected_prefix + item["Key"][len(self.prefix):]
+                    self.s3_client.copy_object(Bucket=self.bucket_name, Key=rejected_key,
+                                               CopySource={"Bucket": self.bucket_name, "Key": item["Key"]})
+                    self.s3_client.delete_object(Bucket=self.bucket_name, Key=item["Key"])
+                    print(f"ERROR :: Observe rejected spooled batch, moved to 's3://{self.bucket_name}/{rejected_key}'")
+                elif shipper.breaker.is_open:
+                    # The collector is down, the remaining batches would fail the same way
+                    break
+            except ClientError as e:
+                # NoSuchKey - another invocation replayed and released it after this one listed it
+                if e.response.get("Error", {}).get("Code") != "NoSuchKey":
+                    print(f"ERROR :: Failed replaying 's3://{self.bucket_name}/{item['Key']}' - {e}")
+            finally:
+                self.s3_client.delete_object(Bucket=self.bucket_name, Key=claim_key)
+        return replayed
+
+
+class LocalSpool:
+    """
+    Spool in a local directory, bounded to 'max_bytes'. Meant for the backfill CLI
+    and benchmarks - Lambda /tmp does not outlive the execution environment.
+    A batch being replayed is renamed to '.claimed', claims older than
+    'claim_timeout' (the replaying process died) are put back in the spool.
+    """
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, claim_timeout=900):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.claim_timeout = claim_timeout
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def size(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory)
+                   if entry.name.endswith((".gz", ".gz.claimed")))
+
+    def reclaim_stale(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".gz.claimed") and time() - entry.stat().st_mtime >= self.claim_timeout:
+                try:
+                    os.rename(entry.path, entry.path[:-len(".claimed")])
+                    print(f"WARNING :: Put back stale claimed batch '{entry.path}'")
+                except FileNotFoundError:
+                    pass
+
+    def put(self, payload, record_count, data_type):
+        with self.lock:
+            if self.size() + len(payload) > self.max_bytes:
+                print(f"ERROR :: Spool '{self.directory}' is full - dropping {record_count} records")
+                return False
+            path = os.path.join(self.directory, spool_name(record_count, data_type))
+            with open(path + ".tmp", "wb") as f:
+                f.write(payload)
+            os.replace(path + ".tmp", path)
+        print(f"WARNING :: Spooled {record_count} records to '{path}'")
+        return True
+
+    def replay(self, shipper, limit):
+        replayed = 0
+        self.reclaim_stale()
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".gz"))[:limit]
+        for name in names:
+            path = os.path.join(self.directory, name)
+            # The rename is the claim, a concurrent replay loses it with FileNotFoundError
+            try:
+                os.rename(path, path + ".claimed")
+            except FileNotFoundError:
+                continue
+            # The claim age counts from now, rename keeps the time the batch was spooled
+            os.utime(path + ".claimed")
+            record_count, data_type = parse_spool_name(name)
+            with open(path + ".claimed", "rb") as f:
+                payload = f.read()
+            outcome = shipper.deliver(payload, record_count, data_type)
+            if outcome == DELIVERY_SENT:
+                os.remove(path + ".claimed")
+                replayed += 1
+            elif outcome == DELIVERY_REJECTED:
+                os.rename(path + ".claimed", path + ".rejected")
+                print(f"ERROR :: Observe rejected spooled batch, moved to '{path}.rejected'")
+            else:
+                os.rename(path + ".claimed", path)
+                if shipper.breaker.is_open:
+                    break
+        return replayed
@@ -31,6 +31,61 @@ variable "observe-token" {
 variable "random-id" {
   type = string
 }
+variable "filter-rules" {
+  description = "JSON filter/projection configuration, see code/record_filter.py"
+  type        = string
+  default     = ""
+}
+variable "http-pool-size" {
+  type    = number
+  default = 10
+}
+variable "idempotency" {
+  description = "Track shipped objects in a DynamoDB table to skip redelivered notifications"
+  type        = bool
+  default     = true
+}
+variable "max-workers" {
+  type    = number
+  default = 4
+}
+variable "output-format" {
+  type    = string
+  default = "json"
+  validation {
+    condition     = var.output-format == "json" || var.output-format == "ndjson"
+    error_message = "Output format can only be 'json' or 'ndjson'."
+  }
+}
+variable "pipeline-uploaders" {
+  type    = number
+  default = 2
+}
+variable "pipeline-queue-size" {
+  type    = number
+  default = 4
+}
+variable "spool" {
+  description = "Spool batches the collector rejects to an S3 bucket and replay them on later invocations"
+  type        = bool
+  default     = true
+}
+variable "spool-retention-days" {
+  type    = number
+  default = 7
+}
+variable "stream-decode" {
+  type    = bool
+  default = true
+}
+variable "batch-max-bytes" {
+  type    = number
+  default = 4000000
+}
+variable "batch-max-records" {
+  type    = number
+  default = 10000
+}
 
 data "aws_iam_policy_document" "cloudtrail" {
   statement {
@@ -86,6 +141,37 @@ data "aws_iam_policy_document" "lambda-permissions" {
     ]
     resources = ["${aws_s3_bucket.cloudtrail.arn}/*"]
   }
+  dynamic "statement" {
+    for_each = aws_s3_bucket.spool
+    content {
+      effect = "Allow"
+      actions = [
+        "s3:PutObject",
+        "s3:GetObject",
+        "s3:DeleteObject"
+      ]
+      resources = ["${statement.value.arn}/*"]
+    }
+  }
+  dynamic "statement" {
+    for_each = aws_s3_bucket.spool
+    content {
+      effect    = "Allow"
+      actions   = ["s3:ListBucket"]
+      resources = [statement.value.arn]
+    }
+  }
+  dynamic "statement" {
+    for_each = aws_dynamodb_table.idempotency
+    content {
+      effect = "Allow"
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:PutItem"
+      ]
+      resources = [statement.value.arn]
+    }
+  }
 }
 
 # Create Trail
@@ -119,6 +205,18 @@ resource "aws_lambda_function" "lambda" {
       CUSTOMER_ID = var.observe-customer-id
       EXTRA       = var.observe-extra
       TOKEN       = var.observe-token
+
+      BATCH_MAX_BYTES     = var.batch-max-bytes
+      BATCH_MAX_RECORDS   = var.batch-max-records
+      FILTER_RULES        = var.filter-rules
+      HTTP_POOL_SIZE      = var.http-pool-size
+      IDEMPOTENCY_TABLE   = var.idempotency ? aws_dynamodb_table.idempotency[0].name : ""
+      MAX_WORKERS         = var.max-workers
+      OUTPUT_FORMAT       = var.output-format
+      PIPELINE_UPLOADERS  = var.pipeline-uploaders
+      PIPELINE_QUEUE_SIZE = var.pipeline-queue-size
+      SPOOL_BUCKET        = var.spool ? aws_s3_bucket.spool[0].id : ""
+      STREAM_DECODE       = var.stream-decode ? "True" : "False"
     }
   }
 }
@@ -165,6 +263,37 @@ resource "aws_s3_bucket_notification" "lambda" {
     events = ["s3:ObjectCreated:*"]
   }
 }
+resource "aws_s3_bucket" "spool" {
+  count         = var.spool ? 1 : 0
+  bucket        = "${lower(var.name)}-spool-${var.random-id}"
+  force_destroy = true
+}
+resource "aws_s3_bucket_lifecycle_configuration" "spool" {
+  count  = var.spool ? 1 : 0
+  bucket = aws_s3_bucket.spool[0].id
+  rule {
+    id     = "expire-spooled-batches"
+    status = "Enabled"
+    filter {}
+    expiration {
+      days = var.spool-retention-days
+    }
+  }
+}
+resource "aws_dynamodb_table" "idempotency" {
+  count        = var.idempotency ? 1 : 0
+  name         = "${var.name}-shipped-objects"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "object_id"
+  attribute {
+    name = "object_id"
+    type = "S"
+  }
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
 resource "aws_lambda_layer_version" "lambda" {
   filename   = "${path.cwd}/${path.module}/code/layer.zip"
   layer_name = "${var.name}-requiuests"
@@ -61,6 +61,7 @@ module "sensor_installer" {
   scenario       = var.scenario
 }
 module "CloudTrail" {
+  depends_on          = [null_resource.this]
   source              = "../CloudTrail-to-Observe"
   name                = "CloudTrail-to-Observe-${random_string.this.id}"
   observe-customer-id = var.Observe["customer_id"]
@@ -78,6 +79,10 @@ resource "aws_s3_object" "this" {
   bucket = aws_s3_bucket.this.bucket
   key    = local.installation_files[count.index]
   source = "./sensor_installer/installation_files/${local.installation_files[count.index]}"
+  # Verified by the install commands after downloading through pre-signed URLs
+  metadata = {
+    sha256 = filesha256("./sensor_installer/installation_files/${local.installation_files[count.index]}")
+  }
 }
 resource "null_resource" "this" {
   provisioner "local-exec" {
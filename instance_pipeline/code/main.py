@@ -2,23 +2,227 @@ import os
 import time
 import json
 import boto3
+import random
+import fnmatch
+import re
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from botocore.exceptions import ClientError
 
+ROLE_SUFFIX = "-default-role"
+
+# Validation result of the shared instance profile and when it was made, kept across warm
+# invocations. An invalid profile is validated again after INVALID_PROFILE_RECHECK seconds
+shared_profile_cache = {}
+INVALID_PROFILE_RECHECK = 300
+
+# Approved image index and AMI metadata, kept across warm invocations
+approved_images_cache = {}
+image_metadata_cache = {}
+
+
+def wait_until(condition, description, timeout=60, initial_delay=0.5, max_delay=5):
+    """
+    Polls 'condition' with jittered exponential backoff until it returns a truthy
+    value or 'timeout' seconds have passed, and returns its last result.
+    ClientErrors raised by the condition count as "not yet".
+    """
+    deadline = time.time() + timeout
+    delay = initial_delay
+    while True:
+        try:
+            result = condition()
+        except ClientError as e:
+            print(f"WARNING :: Still waiting for {description} - {e}")
+            result = None
+        if result:
+            return result
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            print(f"WARNING :: Timed out after {timeout} seconds waiting for {description}")
+            return result
+        time.sleep(min(random.uniform(delay / 2, delay), remaining))
+        delay = min(delay * 2, max_delay)
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class StepTimer:
+    """
+    Times the pipeline steps and prints each one as a CloudWatch embedded metric
+    format (EMF) line, so the step durations can be graphed at p50/p99 per step.
+    The instance id is a property of the line, not a dimension.
+    """
+    def __init__(self, instance_id, namespace=None):
+        self.instance_id = instance_id
+        self.namespace = namespace or os.getenv("METRICS_NAMESPACE", "InstancePipeline")
+
+    @contextmanager
+    def span(self, step, instance_count=1):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.emit(step, (time.time() - started) * 1000, instance_count)
+
+    def emit(self, step, duration_ms, instance_count=1):
+        # A single write, the isolation steps emit from concurrent threads
+        print(json.dumps({
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [["Step"]],
+                    "Metrics": [{"Name": "Duration", "Unit": "Milliseconds"}]
+                }]
+            },
+            "Step": step,
+            "Duration": round(duration_ms, 1),
+            "InstanceId": self.instance_id,
+            "InstanceCount": instance_count
+        }) + "\n", end="")
+
+
+class ApprovedImageIndex:
+    """
+    Approved images as a set of AMI ids plus rules on the AMI owner, name (glob
+    patterns such as 'amzn2-ami-*') and tags. The source is either the legacy comma
+    separated list of ids or a JSON document:
+        {"image_ids": [...], "owners": [...], "name_patterns": [...], "tags": {"golden": "true"}}
+    """
+    def __init__(self, text):
+        text = (text or "").strip()
+        if text.startswith("{"):
+            document = json.loads(text)
+        else:
+            document = {"image_ids": text.split(",")}
+        self.image_ids = {image_id.strip() for image_id in document.get("image_ids", []) if image_id.strip()}
+        self.owners = set(document.get("owners", []))
+        self.name_patterns = [re.compile(fnmatch.translate(pattern)) for pattern in document.get("name_patterns", [])]
+        # EC2 tag values are strings, JSON true/1 are compared as they are written ("true", "1")
+        self.tags = {key: value if isinstance(value, str) else json.dumps(value)
+                     for key, value in document.get("tags", {}).items()}
+
+    @property
+    def has_rules(self):
+        return bool(self.owners or self.name_patterns or self.tags)
+
+    def is_approved(self, image_id, image=None):
+        """
+        'image' is the describe_images entry of the AMI, needed only to evaluate the rules.
+        """
+        if image_id in self.image_ids:
+            return True
+        if not image:
+            return False
+        if image.get("OwnerId") in self.owners:
+            return True
+        if any(pattern.match(image.get("Name", "")) for pattern in self.name_patterns):
+            return True
+        image_tags = {tag["Key"]: tag["Value"] for tag in image.get("Tags", [])}
+        return bool(self.tags) and all(image_tags.get(key) == value for key, value in self.tags.items())
+
+
+def load_approved_images(source, s3_client=None, ssm_client=None):
+    """
+    Returns the approved image index from 'source' - '' or 'env' (APPROVED_IMAGES),
+    'ssm:<parameter name>' or 's3://<bucket>/<key>'. The index is cached for
+    APPROVED_IMAGES_TTL seconds and then revalidated with the S3 ETag / SSM parameter
+    version, so it is only parsed again after it changed.
+    """
+    source = source or "env"
+    ttl = int(os.getenv("APPROVED_IMAGES_TTL", 300))
+    cached = approved_images_cache.get(source)
+    if cached and (source == "env" or time.time() - cached["loaded_at"] < ttl):
+        return cached["index"]
+
+    try:
+        if source == "env":
+            text, version = os.getenv("APPROVED_IMAGES", ""), None
+        elif source.startswith("ssm:"):
+            ssm_client = ssm_client or boto3.client('ssm')
+            parameter = ssm_client.get_parameter(Name=source[len("ssm:"):], WithDecryption=True)["Parameter"]
+            text, version = parameter["Value"], parameter["Version"]
+        elif source.startswith("s3://"):
+            s3_client = s3_client or boto3.client('s3')
+            bucket_name, object_key = source[len("s3://"):].split("/", 1)
+            kwargs = {"IfNoneMatch": cached["version"]} if cached else {}
+            try:
+                response = s3_client.get_object(Bucket=bucket_name, Key=object_key, **kwargs)
+                text, version = response["Body"].read().decode("utf-8"), response["ETag"]
+            except ClientError as e:
+                if cached and e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+                    text, version = None, cached["version"]
+                else:
+                    raise
+        else:
+            raise ValueError(f"Unsupported approved images source '{source}'")
+    except ClientError as e:
+        if not cached:
+            raise
+        # Keeping the last known index, retried on the next invocation
+        print(f"WARNING :: Failed refreshing approved images from '{source}', using the cached index - {e}")
+        return cached["index"]
+
+    if cached and version is not None and version == cached["version"]:
+        index = cached["index"]
+    else:
+        index = ApprovedImageIndex(text)
+        print(f" INFO   :: Loaded {len(index.image_ids)} approved images from '{source}'"
+              f"{' with owner/name/tag rules' if index.has_rules else ''}")
+    approved_images_cache[source] = {"index": index, "version": version, "loaded_at": time.time()}
+    return index
+
+
+def lookup_images(ec2_client, image_ids):
+    """
+    Returns {image_id: image} for the AMIs, describing the ones not cached yet in
+    batches. Images that are gone or not visible map to None.
+    """
+    ttl = int(os.getenv("APPROVED_IMAGES_TTL", 300))
+    missing = [image_id for image_id in set(image_ids)
+               if image_id not in image_metadata_cache or time.time() - image_metadata_cache[image_id][0] >= ttl]
+    for chunk in chunks(missing, 200):
+        found = {}
+        for page in ec2_client.get_paginator("describe_images").paginate(Filters=[{'Name': 'image-id', 'Values': chunk}]):
+            for image in page["Images"]:
+                found[image["ImageId"]] = image
+        for image_id in chunk:
+            image_metadata_cache[image_id] = (time.time(), found.get(image_id))
+    return {image_id: image_metadata_cache[image_id][1] for image_id in image_ids}
+
+
+def approved_image_ids(ec2_client, image_ids):
+    """
+    Returns the subset of 'image_ids' that is approved, describing the AMIs only
+    when the index has owner/name/tag rules and the id is not listed explicitly.
+    """
+    index = load_approved_images(os.getenv("APPROVED_IMAGES_SOURCE"))
+    unlisted = [image_id for image_id in set(image_ids) if image_id not in index.image_ids]
+    images = lookup_images(ec2_client, unlisted) if index.has_rules and unlisted else {}
+    return {image_id for image_id in set(image_ids) if index.is_approved(image_id, images.get(image_id))}
+
 
 class InstancePipeline:
-    def __init__(self, event, region, instance_id):
+    def __init__(self, event, region, instance_id, iam_client=None, ec2_client=None):
         self.instance_id = instance_id
         self.event = event
-        self.iam_client = boto3.client('iam')
-        self.ec2_client = boto3.client('ec2', region_name=region)
+        self.iam_client = iam_client or boto3.client('iam')
+        self.ec2_client = ec2_client or boto3.client('ec2', region_name=region)
         self.ssm_policy_arn = "arn:aws:iam::aws:policy/AmazonSSMManagedInstanceCore"
-        self.approved_images = os.getenv("APPROVED_IMAGES", "")
         self.s3_bucket_name = os.getenv("S3_BUCKET_NAME")
+        self.wait_timeout = int(os.getenv("WAIT_TIMEOUT", 60))
+        self.shared_instance_profile = os.getenv("SHARED_INSTANCE_PROFILE")
+        self.timer = StepTimer(instance_id)
 
     def check_approved_ami(self, current_instance):
+        approved_images = approved_image_ids(self.ec2_client, [instance["ImageId"] for instance in current_instance])
         for instance in current_instance:
             cur_image_id = instance["ImageId"]
-            approved_images = [image.strip() for image in self.approved_images.split(",")]
             if cur_image_id not in approved_images:
                 self.ec2_client.stop_instances(InstanceIds=[self.instance_id], Force=True)
                 return False
@@ -26,16 +230,22 @@ class InstancePipeline:
                 print(f" INFO   :: Instance '{self.instance_id}' is using an approved image")
                 return True
 
-    def isolating_instance_role_permissions(self):
+    def get_active_profile_associations(self):
         associations = self.ec2_client.describe_iam_instance_profile_associations(
             Filters=[{'Name': 'instance-id', 'Values': [self.instance_id]}]
         )
-        if "IamInstanceProfileAssociations" in associations and len(associations["IamInstanceProfileAssociations"]) > 0:
-            for association in associations['IamInstanceProfileAssociations']:
+        return [association for association in associations.get("IamInstanceProfileAssociations", [])
+                if association.get("State") in ("associating", "associated", "disassociating")]
+
+    def isolating_instance_role_permissions(self):
+        associations = self.get_active_profile_associations()
+        if len(associations) > 0:
+            for association in associations:
                 association_id = association['AssociationId']
                 self.ec2_client.disassociate_iam_instance_profile(AssociationId=association_id)
                 print(f" INFO   :: Role was detached from instance '{self.instance_id}'")
-                time.sleep(10)
+            wait_until(lambda: len(self.get_active_profile_associations()) == 0,
+                       f"the instance profile of '{self.instance_id}' to be disassociated", self.wait_timeout)
         else:
             print(" INFO   :: Instance doesn't have a role attached")
 
@@ -89,7 +299,9 @@ class InstancePipeline:
                 Description=f"Temp Isolated Security Group for {self.instance_id}",
                 GroupName=expected_security_group_name,
                 VpcId=vpc_id)["GroupId"]
-            time.sleep(5)
+            wait_until(lambda: self.ec2_client.describe_security_groups(
+                           Filters=[{'Name': 'group-name', 'Values': [expected_security_group_name]}])["SecurityGroups"],
+                       f"security group '{expected_security_group_name}' to be visible", self.wait_timeout)
             self.revoke_security_group(expected_security_group_name)
             print(" INFO   :: New isolated Security Group was created")
 
@@ -106,16 +318,16 @@ class InstancePipeline:
 
     def tag_instance(self, tags, current_tags):
         existing_tags_keys = [tag["Key"] for tag in current_tags]
-        for tag in tags:
-            if tag["Key"] not in existing_tags_keys:
-                try:
-                    self.ec2_client.create_tags(
-                        Resources=[self.instance_id],
-                        Tags=[{'Key': tag["Key"], 'Value': str(tag["Value"])}]
-                    )
-                    print(f" INFO   :: Updated the '{tag["Key"]}' tag for instance '{self.instance_id}' have been updated")
-                except ClientError as e:
-                    print(f"ERROR :: Failed creating tags for instance '{self.instance_id}' - {e}")
+        missing_tags = [{'Key': tag["Key"], 'Value': str(tag["Value"])} for tag in tags
+                        if tag["Key"] not in existing_tags_keys]
+        if len(missing_tags) == 0:
+            return
+        try:
+            self.ec2_client.create_tags(Resources=[self.instance_id], Tags=missing_tags)
+            tag_keys = ", ".join(tag["Key"] for tag in missing_tags)
+            print(f" INFO   :: Updated the tags '{tag_keys}' for instance '{self.instance_id}'")
+        except ClientError as e:
+            print(f"ERROR :: Failed creating tags for instance '{self.instance_id}' - {e}")
 
     @staticmethod
     def instance_existing_tags(current_tags):
@@ -132,6 +344,9 @@ class InstancePipeline:
         return isolation_status, sensor_installed
 
     def temporary_isolate_instance(self, current_instance):
+        """
+        Returns True when the instance was isolated now, False when it was skipped.
+        """
         for instance in current_instance:
             current_tags = instance.get('Tags', [])
             security_groups = instance.get("SecurityGroups", "None")
@@ -150,19 +365,74 @@ class InstancePipeline:
             isolated, sensor_installed = self.instance_existing_tags(current_tags)
 
             if not isolated and not sensor_installed:
-                self.isolating_instance_role_permissions()
-                self.isolating_instance_network_access(vpc_id)
-                self.tag_instance(new_tags, current_tags)
+                with self.timer.span("isolate"):
+                    # The profile and the security groups are independent resources, both are isolated at once
+                    with ThreadPoolExecutor(max_workers=2) as executor:
+                        role_detach = executor.submit(self.timed, "role_detach", self.isolating_instance_role_permissions)
+                        sg_isolate = executor.submit(self.timed, "sg_isolate", self.isolating_instance_network_access, vpc_id)
+                        role_detach.result()
+                        sg_isolate.result()
+                    with self.timer.span("tag"):
+                        self.tag_instance(new_tags, current_tags)
+                return True
 
             elif not isolated and sensor_installed:
                 print(f" INFO   :: Instance '{self.instance_id}' have a sensor - skipping")
-                exit(0)
+                return False
             else:
                 print(f" INFO   :: Instance '{self.instance_id}' is already isolated - skipping")
-                exit(0)
+                return False
+
+    def timed(self, step, function, *args):
+        with self.timer.span(step):
+            return function(*args)
+
+    def get_shared_instance_profile(self):
+        """
+        Returns the shared instance profile name once validated to hold a role with the
+        SSM managed policy, None when it is not configured or not valid.
+        """
+        profile_name = self.shared_instance_profile
+        if not profile_name:
+            return None
+        cached = shared_profile_cache.get(profile_name)
+        if cached and (cached[0] or time.time() - cached[1] < INVALID_PROFILE_RECHECK):
+            return cached[0]
+
+        try:
+            roles = self.iam_client.get_instance_profile(InstanceProfileName=profile_name)["InstanceProfile"]["Roles"]
+            attached_policies = [policy["PolicyArn"] for role in roles
+                                 for policy in self.iam_client.list_attached_role_policies(RoleName=role["RoleName"])["AttachedPolicies"]]
+        except ClientError as e:
+            # Not cached, the next invocation validates again
+            print(f"ERROR :: Failed validating shared instance profile '{profile_name}' - {e}")
+            return None
+
+        if self.ssm_policy_arn in attached_policies:
+            print(f" INFO   :: Validated shared instance profile '{profile_name}'")
+            shared_profile_cache[profile_name] = (profile_name, time.time())
+        else:
+            print(f"WARNING :: Shared instance profile '{profile_name}' has no role with the SSM policy - creating roles per instance")
+            shared_profile_cache[profile_name] = (None, time.time())
+        return shared_profile_cache[profile_name][0]
+
+    def associate_instance_profile(self, instance_profile_name):
+        # EC2 rejects a new instance profile until IAM propagated it, the association itself is the readiness check
+        associated = wait_until(lambda: self.ec2_client.associate_iam_instance_profile(
+                                    InstanceId=self.instance_id,
+                                    IamInstanceProfile={
+                                        'Name': instance_profile_name
+                                    }
+                                ),
+                                f"instance profile '{instance_profile_name}' to propagate to EC2", self.wait_timeout)
+        if associated:
+            print(f" INFO   :: Attached instance profile '{instance_profile_name}' to '{self.instance_id}' instance")
+        else:
+            print(f"ERROR :: Failed attaching instance profile '{instance_profile_name}' to '{self.instance_id}' instance")
+        return bool(associated)
 
     def create_role(self):
-        cur_role_name = f'{self.instance_id}-default-role'
+        cur_role_name = f'{self.instance_id}{ROLE_SUFFIX}'
 
         assume_role_policy = {
             "Version": "2012-10-17",
@@ -219,42 +489,48 @@ class InstancePipeline:
         return cur_role_name
 
     def add_required_permissions(self, current_instance):
+        """
+        Returns False when no instance profile could be associated to the instance.
+        """
+        attached = True
         for instance in current_instance:
             if "IamInstanceProfile" in instance:
                 print(f" INFO   :: Instance '{self.instance_id}' already have a role")
 
             else:
-                print(" INFO   :: Instance is without a role")
-                ssm_role_name = self.create_role()
-                try:
-                    self.iam_client.create_instance_profile(InstanceProfileName=ssm_role_name)
-                except ClientError as e:
-                    if "EntityAlreadyExists" in str(e):
-                        print(f"WARNING :: Instance Profile '{ssm_role_name}' already exists")
-                time.sleep(10)
-
-                try:
-                    self.iam_client.add_role_to_instance_profile(
-                        InstanceProfileName=ssm_role_name,
-                        RoleName=ssm_role_name
-                    )
-                    print(" INFO   :: Added role to instance profile")
-                except ClientError as e:
-                    if "InstanceSessionsPerInstanceProfile: 1" in str(e):
-                        existing_instance_profile_name = self.iam_client.list_instance_profiles_for_role(RoleName=ssm_role_name)["InstanceProfiles"][0]["InstanceProfileName"]
-                        if existing_instance_profile_name == ssm_role_name:
-                            pass
-                        else:
-                            exit(9)
-                time.sleep(10)
-
-                self.ec2_client.associate_iam_instance_profile(
-                    InstanceId=self.instance_id,
-                    IamInstanceProfile={
-                        'Name': ssm_role_name
-                    }
-                )
-                print(f" INFO   :: Attached role to '{self.instance_id}' instance")
+                with self.timer.span("profile_attach"):
+                    attached = self.attach_ssm_instance_profile() and attached
+        return attached
+
+    def attach_ssm_instance_profile(self):
+        shared_profile = self.get_shared_instance_profile()
+        if shared_profile and self.associate_instance_profile(shared_profile):
+            return True
+
+        print(" INFO   :: Instance is without a role")
+        ssm_role_name = self.create_role()
+        try:
+            self.iam_client.create_instance_profile(InstanceProfileName=ssm_role_name)
+        except ClientError as e:
+            if "EntityAlreadyExists" in str(e):
+                print(f"WARNING :: Instance Profile '{ssm_role_name}' already exists")
+        wait_until(lambda: self.iam_client.get_instance_profile(InstanceProfileName=ssm_role_name),
+                   f"instance profile '{ssm_role_name}' to be created", self.wait_timeout)
+
+        try:
+            self.iam_client.add_role_to_instance_profile(
+                InstanceProfileName=ssm_role_name,
+                RoleName=ssm_role_name
+            )
+            print(" INFO   :: Added role to instance profile")
+        except ClientError as e:
+            if "InstanceSessionsPerInstanceProfile: 1" in str(e):
+                existing_instance_profile_name = self.iam_client.list_instance_profiles_for_role(RoleName=ssm_role_name)["InstanceProfiles"][0]["InstanceProfileName"]
+                if existing_instance_profile_name != ssm_role_name:
+                    raise RuntimeError(f"Role '{ssm_role_name}' belongs to instance profile '{existing_instance_profile_name}'")
+        wait_until(lambda: self.iam_client.get_instance_profile(InstanceProfileName=ssm_role_name)["InstanceProfile"]["Roles"],
+                   f"role '{ssm_role_name}' to be added to its instance profile", self.wait_timeout)
+        return self.associate_instance_profile(ssm_role_name)
 
     def describe_instance(self):
         described_instance = self.ec2_client.describe_instances(InstanceIds=[self.instance_id])
@@ -265,26 +541,206 @@ class InstancePipeline:
             return current_instance
 
     def main(self):
-        current_instance = self.describe_instance()
+        with self.timer.span("describe"):
+            current_instance = self.describe_instance()
 
         # STEP 1 - Checking if the AMI was pre-approved and terminating in the case it wasn't
-        ami_is_approved = self.check_approved_ami(current_instance)
+        with self.timer.span("ami_check"):
+            ami_is_approved = self.check_approved_ami(current_instance)
 
         if ami_is_approved:
             # STEP 2 - Isolation to all new instances
-            self.temporary_isolate_instance(current_instance)
+            if not self.temporary_isolate_instance(current_instance):
+                return
 
             # STEP 3 (if not isolated) - add required SSM permissions
-            refreshed_current_instance = self.describe_instance()
+            with self.timer.span("describe"):
+                refreshed_current_instance = self.describe_instance()
             self.add_required_permissions(refreshed_current_instance)
         else:
             print(f"WARNING :: Instance {self.instance_id} was using unapproved image and was stopped")
 
+    @staticmethod
+    def describe_instances(ec2_client, instance_ids):
+        """
+        Describes many instances with as few calls as possible. Returns {instance_id: instance}.
+        Filters are used instead of InstanceIds so one unknown id does not fail the whole call.
+        """
+        instances = {}
+        paginator = ec2_client.get_paginator("describe_instances")
+        for chunk in chunks(instance_ids, 200):
+            for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': chunk}]):
+                for reservation in page["Reservations"]:
+                    for instance in reservation["Instances"]:
+                        instances[instance["InstanceId"]] = instance
+        return instances
+
+    @classmethod
+    def run_batch(cls, event, region, instance_ids):
+        """
+        Runs the pipeline for many instances at once, e.g. a scale-out buffered in SQS.
+        The instances are described together, the AMI check is done once per image and
+        unapproved instances are stopped in a single call. Returns {instance_id: outcome}.
+        """
+        instance_ids = list(dict.fromkeys(instance_ids))
+        pipeline = cls(event, region, None)
+        outcomes = {instance_id: "not_found" for instance_id in instance_ids}
+        with pipeline.timer.span("describe", len(instance_ids)):
+            instances = cls.describe_instances(pipeline.ec2_client, instance_ids)
+
+        # STEP 1 - Checking the AMIs once per image and stopping all unapproved instances together
+        with pipeline.timer.span("ami_check", len(instances)):
+            approved_images = approved_image_ids(pipeline.ec2_client, [instance["ImageId"] for instance in instances.values()])
+        unapproved_ids = [instance_id for instance_id, instance in instances.items()
+                          if instance["ImageId"] not in approved_images]
+        for chunk in chunks(unapproved_ids, 1000):
+            try:
+                pipeline.ec2_client.stop_instances(InstanceIds=chunk, Force=True)
+                outcomes.update({instance_id: "stopped" for instance_id in chunk})
+                print(f"WARNING :: Stopped {len(chunk)} instances using unapproved images - {chunk}")
+            except ClientError as e:
+                outcomes.update({instance_id: "failed" for instance_id in chunk})
+                print(f"ERROR :: Failed stopping instances {chunk} - {e}")
+
+        # STEP 2 - Isolation of every approved instance on BATCH_WORKERS threads sharing the clients
+        batch_workers = int(os.getenv("BATCH_WORKERS", 10))
+
+        def isolate(instance_id):
+            instance_pipeline = cls(event, region, instance_id, pipeline.iam_client, pipeline.ec2_client)
+            try:
+                return instance_id, "isolated" if instance_pipeline.temporary_isolate_instance([instances[instance_id]]) else "skipped"
+            except Exception as e:
+                print(f"ERROR :: Failed isolating instance '{instance_id}' - {e}")
+                return instance_id, "failed"
+
+        approved_ids = [instance_id for instance_id in instances if instance_id not in unapproved_ids]
+        with ThreadPoolExecutor(max_workers=batch_workers) as executor:
+            isolation = dict(executor.map(isolate, approved_ids))
+        isolated_ids = [instance_id for instance_id, outcome in isolation.items() if outcome == "isolated"]
+        outcomes.update({instance_id: outcome for instance_id, outcome in isolation.items() if outcome != "isolated"})
+
+        # STEP 3 - SSM permissions, based on one refreshed describe of the isolated instances
+        refreshed_instances = {}
+        if isolated_ids:
+            with pipeline.timer.span("describe", len(isolated_ids)):
+                refreshed_instances = cls.describe_instances(pipeline.ec2_client, isolated_ids)
+
+        def add_permissions(instance_id):
+            instance_pipeline = cls(event, region, instance_id, pipeline.iam_client, pipeline.ec2_client)
+            try:
+                if instance_pipeline.add_required_permissions([refreshed_instances[instance_id]]):
+                    return instance_id, "isolated"
+                return instance_id, "failed"
+            except Exception as e:
+                print(f"ERROR :: Failed adding permissions to instance '{instance_id}' - {e}")
+                return instance_id, "failed"
+
+        with ThreadPoolExecutor(max_workers=batch_workers) as executor:
+            outcomes.update(executor.map(add_permissions, isolated_ids))
+
+        for instance_id, outcome in outcomes.items():
+            print(f" INFO   :: Instance '{instance_id}' - {outcome}")
+        return outcomes
+
+
+def delete_role(iam_client, role_name):
+    for instance_profile in iam_client.list_instance_profiles_for_role(RoleName=role_name)["InstanceProfiles"]:
+        iam_client.remove_role_from_instance_profile(InstanceProfileName=instance_profile["InstanceProfileName"], RoleName=role_name)
+        iam_client.delete_instance_profile(InstanceProfileName=instance_profile["InstanceProfileName"])
+    for policy in iam_client.list_attached_role_policies(RoleName=role_name)["AttachedPolicies"]:
+        iam_client.detach_role_policy(RoleName=role_name, PolicyArn=policy["PolicyArn"])
+    for policy_name in iam_client.list_role_policies(RoleName=role_name)["PolicyNames"]:
+        iam_client.delete_role_policy(RoleName=role_name, PolicyName=policy_name)
+    iam_client.delete_role(RoleName=role_name)
+
+
+def sweep_orphaned_roles(regions, min_age_hours=1, confirmed_only=False):
+    """
+    Deletes the per-instance '<instance-id>-default-role' roles (and their instance profiles)
+    whose instance is terminated or gone in all 'regions'. Roles younger than 'min_age_hours'
+    are kept, their instance may still be in the middle of the pipeline.
+    Role names are global, so an instance missing from 'regions' may live in another one.
+    With 'confirmed_only' only roles of instances seen terminated are deleted.
+    """
+    iam_client = boto3.client('iam')
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=min_age_hours)
+    candidates = {}
+    for page in iam_client.get_paginator("list_roles").paginate(PathPrefix="/"):
+        for role in page["Roles"]:
+            role_name = role["RoleName"]
+            if role_name.startswith("i-") and role_name.endswith(ROLE_SUFFIX) and role["CreateDate"] < cutoff:
+                candidates[role_name[:-len(ROLE_SUFFIX)]] = role_name
+
+    live_instance_ids = set()
+    terminated_instance_ids = set()
+    for region in regions:
+        ec2_client = boto3.client('ec2', region_name=region)
+        instances = InstancePipeline.describe_instances(ec2_client, list(candidates))
+        for instance_id, instance in instances.items():
+            if instance["State"]["Name"] == "terminated":
+                terminated_instance_ids.add(instance_id)
+            else:
+                live_instance_ids.add(instance_id)
+
+    deleted = []
+    for instance_id, role_name in candidates.items():
+        if instance_id in live_instance_ids:
+            continue
+        if confirmed_only and instance_id not in terminated_instance_ids:
+            continue
+        try:
+            delete_role(iam_client, role_name)
+            deleted.append(role_name)
+            print(f" INFO   :: Deleted orphaned role '{role_name}'")
+        except ClientError as e:
+            print(f"ERROR :: Failed deleting orphaned role '{role_name}' - {e}")
+    print(f" INFO   :: Swept {len(deleted)} of {len(candidates)} per-instance roles")
+    return deleted
+
+
+def get_batch_instance_ids(event):
+    """
+    Returns {region: [(message_id, instance_id)]} from an SQS event whose messages are
+    EC2 state-change events delivered by the EventBridge rule.
+    """
+    instance_ids = {}
+    for record in event["Records"]:
+        message = json.loads(record["body"])
+        region = message.get("region", record.get("awsRegion"))
+        instance_ids.setdefault(region, []).append((record["messageId"], message["detail"]["instance-id"]))
+    return instance_ids
+
+
 def lambda_handler(event, context):
-    region = event['region']
-    instance_id = event["detail"]['instance-id']
-    print(f" INFO   :: Detected a new running instance - '{instance_id}'")
-    InstancePipeline(event, region, instance_id).main()
+    if event.get("action") == "sweep_orphaned_roles":
+        regions = os.getenv("SWEEP_REGIONS")
+        if regions:
+            regions = [region.strip() for region in regions.split(",") if region.strip()]
+            return {"deleted_roles": sweep_orphaned_roles(regions)}
+        # Without the full list of pipeline regions a missing instance may live elsewhere
+        print("WARNING :: SWEEP_REGIONS is not set - only deleting roles of instances seen terminated in this region")
+        return {"deleted_roles": sweep_orphaned_roles([os.getenv("AWS_REGION", "us-east-1")], confirmed_only=True)}
+
+    if "Records" not in event:
+        region = event['region']
+        instance_id = event["detail"]['instance-id']
+        print(f" INFO   :: Detected a new running instance - '{instance_id}'")
+        InstancePipeline(event, region, instance_id).main()
+        return
+
+    results = []
+    for region, messages in get_batch_instance_ids(event).items():
+        print(f" INFO   :: Detected {len(messages)} new running instances in '{region}'")
+        outcomes = InstancePipeline.run_batch(event, region, [instance_id for _, instance_id in messages])
+        results.extend({"message_id": message_id, "instance_id": instance_id, "outcome": outcomes[instance_id]}
+                       for message_id, instance_id in messages)
+
+    # Failed and not yet visible instances are retried by SQS
+    failed_message_ids = {result["message_id"] for result in results if result["outcome"] in ("failed", "not_found")}
+    return {
+        "results": results,
+        "batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_message_ids]
+    }
 
 # For testing -->
 #
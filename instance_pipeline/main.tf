@@ -7,6 +7,59 @@ variable "s3_bucket_name" {
 variable "approved_images" {
   type = string
 }
+variable "approved_images_source" {
+  type        = string
+  default     = ""
+  description = "Where the approved images are read from - '' for the approved_images variable, 'ssm:<parameter>' or 's3://<bucket>/<key>'"
+}
+variable "approved_images_ttl" {
+  type        = number
+  default     = 300
+  description = "Seconds the approved images and AMI metadata are cached before revalidation"
+}
+variable "wait_timeout" {
+  type    = number
+  default = 60
+}
+variable "batch_mode" {
+  type        = bool
+  default     = false
+  description = "Buffer the state-change events in SQS and process launches in batches"
+}
+variable "batch_size" {
+  type    = number
+  default = 50
+}
+variable "batch_workers" {
+  type        = number
+  default     = 10
+  description = "Instances of a batch isolated and given SSM permissions in parallel"
+}
+variable "batch_window" {
+  type        = number
+  default     = 20
+  description = "Seconds SQS waits to fill a batch before invoking the function"
+}
+variable "shared_instance_profile" {
+  type        = bool
+  default     = true
+  description = "Associate one pre-provisioned SSM instance profile instead of creating a role per instance"
+}
+variable "sweep_schedule" {
+  type        = string
+  default     = "rate(1 day)"
+  description = "Schedule of the cleanup of per-instance roles whose instance is gone"
+}
+variable "sweep_regions" {
+  type        = string
+  default     = ""
+  description = "Comma separated regions the pipeline runs in, checked for live instances before a role is deleted. When empty only roles of instances seen terminated in the function region are deleted"
+}
+
+locals {
+  approved_images_parameter = startswith(var.approved_images_source, "ssm:") ? trimprefix(trimprefix(var.approved_images_source, "ssm:"), "/") : ""
+  approved_images_object    = startswith(var.approved_images_source, "s3://") ? trimprefix(var.approved_images_source, "s3://") : ""
+}
 
 data "aws_iam_policy" "AWSLambdaBasicExecutionRole" {
   arn = "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
@@ -20,6 +73,35 @@ data "aws_iam_policy_document" "this" {
     ]
     resources = ["arn:aws:iam::${data.aws_caller_identity.this.account_id}:role/*-default-role"]
   }
+  statement {
+    actions = [
+      "iam:DetachRolePolicy",
+      "iam:DeleteRolePolicy",
+      "iam:ListRolePolicies",
+      "iam:ListAttachedRolePolicies",
+      "iam:RemoveRoleFromInstanceProfile",
+      "iam:DeleteInstanceProfile",
+      "iam:DeleteRole"
+    ]
+    resources = [
+      "arn:aws:iam::${data.aws_caller_identity.this.account_id}:role/*-default-role",
+      "arn:aws:iam::${data.aws_caller_identity.this.account_id}:instance-profile/*-default-role"
+    ]
+  }
+  statement {
+    actions   = ["iam:ListRoles"]
+    resources = ["*"]
+  }
+  dynamic "statement" {
+    for_each = var.shared_instance_profile ? [1] : []
+    content {
+      actions = [
+        "iam:PassRole",
+        "iam:ListAttachedRolePolicies"
+      ]
+      resources = [aws_iam_role.shared[0].arn]
+    }
+  }
   statement {
     actions = [
       "iam:AttachRolePolicy",
@@ -27,6 +109,7 @@ data "aws_iam_policy_document" "this" {
       "iam:CreateInstanceProfile",
       "iam:AddRoleToInstanceProfile",
       "iam:ListInstanceProfilesForRole",
+      "iam:GetInstanceProfile",
       "ec2:StopInstances",
       "ec2:DescribeIamInstanceProfileAssociations",
       "ec2:DisassociateIamInstanceProfile",
@@ -38,10 +121,36 @@ data "aws_iam_policy_document" "this" {
       "ec2:CreateTags",
       "ec2:AssociateIamInstanceProfile",
       "ec2:DescribeInstances",
+      "ec2:DescribeImages",
       "ec2:CreateSecurityGroup"
     ]
     resources = ["*"]
   }
+  dynamic "statement" {
+    for_each = local.approved_images_parameter != "" ? [1] : []
+    content {
+      actions   = ["ssm:GetParameter"]
+      resources = ["arn:aws:ssm:*:${data.aws_caller_identity.this.account_id}:parameter/${local.approved_images_parameter}"]
+    }
+  }
+  dynamic "statement" {
+    for_each = local.approved_images_object != "" ? [1] : []
+    content {
+      actions   = ["s3:GetObject"]
+      resources = ["arn:aws:s3:::${local.approved_images_object}"]
+    }
+  }
+  dynamic "statement" {
+    for_each = var.batch_mode ? [1] : []
+    content {
+      actions = [
+        "sqs:ReceiveMessage",
+        "sqs:DeleteMessage",
+        "sqs:GetQueueAttributes"
+      ]
+      resources = [aws_sqs_queue.this[0].arn]
+    }
+  }
 }
 
 resource "aws_lambda_function" "this" {
@@ -56,6 +165,12 @@ resource "aws_lambda_function" "this" {
     variables = {
       S3_BUCKET_NAME = var.s3_bucket_name
       APPROVED_IMAGES = var.approved_images
+      APPROVED_IMAGES_SOURCE = var.approved_images_source
+      APPROVED_IMAGES_TTL = var.approved_images_ttl
+      WAIT_TIMEOUT = var.wait_timeout
+      SHARED_INSTANCE_PROFILE = var.shared_instance_profile ? aws_iam_instance_profile.shared[0].name : ""
+      SWEEP_REGIONS = var.sweep_regions
+      BATCH_WORKERS = var.batch_workers
     }
   }
 }
@@ -106,11 +221,12 @@ resource "aws_cloudwatch_event_rule" "this" {
 EOF
 }
 resource "aws_cloudwatch_event_target" "this" {
-  arn       = aws_lambda_function.this.arn
+  arn       = var.batch_mode ? aws_sqs_queue.this[0].arn : aws_lambda_function.this.arn
   rule      = aws_cloudwatch_event_rule.this.name
   target_id = aws_lambda_function.this.id
 }
 resource "aws_lambda_permission" "this" {
+  count          = var.batch_mode ? 0 : 1
   action         = "lambda:InvokeFunction"
   function_name  = aws_lambda_function.this.function_name
   principal      = "events.amazonaws.com"
@@ -118,3 +234,92 @@ resource "aws_lambda_permission" "this" {
   source_arn     = aws_cloudwatch_event_rule.this.arn
   source_account = data.aws_caller_identity.this.account_id
 }
+resource "aws_sqs_queue" "this" {
+  count                      = var.batch_mode ? 1 : 0
+  name                       = "${var.name}-queue"
+  visibility_timeout_seconds = aws_lambda_function.this.timeout + 60
+  message_retention_seconds  = 3600
+}
+resource "aws_sqs_queue_policy" "this" {
+  count     = var.batch_mode ? 1 : 0
+  queue_url = aws_sqs_queue.this[0].id
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action    = "sqs:SendMessage"
+        Effect    = "Allow"
+        Principal = { Service = "events.amazonaws.com" }
+        Resource  = aws_sqs_queue.this[0].arn
+        Condition = { ArnEquals = { "aws:SourceArn" = aws_cloudwatch_event_rule.this.arn } }
+      },
+    ]
+  })
+}
+resource "aws_lambda_event_source_mapping" "this" {
+  count                              = var.batch_mode ? 1 : 0
+  event_source_arn                   = aws_sqs_queue.this[0].arn
+  function_name                      = aws_lambda_function.this.arn
+  batch_size                         = var.batch_size
+  maximum_batching_window_in_seconds = var.batch_window
+  function_response_types            = ["ReportBatchItemFailures"]
+}
+resource "aws_iam_role" "shared" {
+  count = var.shared_instance_profile ? 1 : 0
+  name  = "${var.name}-shared-ssm-role"
+  assume_role_policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action = "sts:AssumeRole"
+        Effect = "Allow"
+        Principal = {
+          Service = "ec2.amazonaws.com"
+        }
+      },
+    ]
+  })
+}
+resource "aws_iam_role_policy_attachment" "shared" {
+  count      = var.shared_instance_profile ? 1 : 0
+  role       = aws_iam_role.shared[0].name
+  policy_arn = "arn:aws:iam::aws:policy/AmazonSSMManagedInstanceCore"
+}
+resource "aws_iam_role_policy" "shared" {
+  count = var.shared_instance_profile ? 1 : 0
+  name  = "S3-Access"
+  role  = aws_iam_role.shared[0].id
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action   = ["s3:GetObject"]
+        Effect   = "Allow"
+        Resource = "arn:aws:s3:::${var.s3_bucket_name}/*"
+      },
+    ]
+  })
+}
+resource "aws_iam_instance_profile" "shared" {
+  count = var.shared_instance_profile ? 1 : 0
+  name  = "${var.name}-shared-ssm-profile"
+  role  = aws_iam_role.shared[0].name
+}
+resource "aws_cloudwatch_event_rule" "sweep" {
+  name                = "${var.name}-sweep-rule"
+  schedule_expression = var.sweep_schedule
+}
+resource "aws_cloudwatch_event_target" "sweep" {
+  arn       = aws_lambda_function.this.arn
+  rule      = aws_cloudwatch_event_rule.sweep.name
+  target_id = "${aws_lambda_function.this.id}-sweep"
+  input     = jsonencode({ action = "sweep_orphaned_roles" })
+}
+resource "aws_lambda_permission" "sweep" {
+  action         = "lambda:InvokeFunction"
+  function_name  = aws_lambda_function.this.function_name
+  principal      = "events.amazonaws.com"
+  statement_id   = "invoke-${var.name}-sweep"
+  source_arn     = aws_cloudwatch_event_rule.sweep.arn
+  source_account = data.aws_caller_identity.this.account_id
+}
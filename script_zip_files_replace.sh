@@ -21,3 +21,16 @@ for d in "${dirs[@]}"; do
     fi
     echo ""
 done
+
+# CloudTrail-to-Observe ships several modules next to main.py
+d="CloudTrail-to-Observe"
+zip_file="../$d/code/code.zip"
+echo "$d"
+echo "================="
+if [ -f "$zip_file" ]; then
+    echo "INFO :: Removing $zip_file"
+    rm -f "$zip_file"
+fi
+echo "INFO :: Creating $zip_file with ../$d/code/*.py"
+zip -j "$zip_file" ../$d/code/*.py
+echo ""
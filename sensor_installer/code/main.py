@@ -1,92 +1,361 @@
 import os
 import json
 import boto3
+import base64
+import uuid
+import random
+import hashlib
+import threading
 from time import time, sleep
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+THROTTLING_ERRORS = {"RequestLimitExceeded", "Throttling", "ThrottlingException"}
+FINISHED_STATUSES = {"Success", "Failed", "Cancelled", "TimedOut", "Undeliverable", "Terminated"}
+# SendCommand accepts at most 50 instance ids per call
+SEND_COMMAND_BATCH_SIZE = 50
+# describe_instances accepts at most 200 values per filter
+DESCRIBE_FILTER_SIZE = 200
+# '<command id>:<run id>' of the run releasing an instance after that command succeeded
+RELEASE_OWNER_TAG = "sensor_release_owner"
+
+# SHA-256 of artifacts that had to be hashed here, by (bucket, key, ETag), kept across warm invocations
+artifact_checksum_cache = {}
+
+
+def wait_until(condition, description, timeout=60, initial_delay=0.5, max_delay=5):
+    """
+    Polls 'condition' with jittered exponential backoff until it returns a truthy
+    value or 'timeout' seconds have passed, and returns its last result.
+    ClientErrors raised by the condition count as "not yet".
+    """
+    deadline = time() + timeout
+    delay = initial_delay
+    while True:
+        try:
+            result = condition()
+        except ClientError as e:
+            print(f"WARNING :: Still waiting for {description} - {e}")
+            result = None
+        if result:
+            return result
+        remaining = deadline - time()
+        if remaining <= 0:
+            print(f"WARNING :: Timed out after {timeout} seconds waiting for {description}")
+            return result
+        sleep(min(random.uniform(delay / 2, delay), remaining))
+        delay = min(delay * 2, max_delay)
+
+
+class RateLimiter:
+    """
+    Thread safe token bucket allowing 'rate' calls per second with bursts of up to
+    'burst' calls, shared by the release workers so together they stay under the
+    EC2 mutating API limits.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class TagCommandStore:
+    """
+    Keeps the install command in flight on each instance, with the lease that guards
+    it, as instance tags. Overlapping runs read them with the instance tags they
+    already fetch. Any object with the same three methods can replace it.
+    """
+    COMMAND_TAG = "sensor_command_id"
+    LEASE_TAG = "sensor_command_lease"
+
+    def __init__(self, tag_instances):
+        self.tag_instances = tag_instances
+
+    def in_flight(self, tags):
+        """
+        Returns the command id still leased on the instance, None when there is none.
+        """
+        command_id = tags.get(self.COMMAND_TAG)
+        try:
+            lease_until = float(tags.get(self.LEASE_TAG) or 0)
+        except ValueError:
+            lease_until = 0
+        return command_id if command_id and time() < lease_until else None
+
+    def record(self, command_id, instance_ids, lease_seconds):
+        self.tag_instances(instance_ids, [
+            {'Key': self.COMMAND_TAG, 'Value': command_id},
+            {'Key': self.LEASE_TAG, 'Value': str(int(time() + lease_seconds))}
+        ])
+
+    def expire(self, instance_ids):
+        self.tag_instances(instance_ids, [{'Key': self.LEASE_TAG, 'Value': "0"}])
+
+
+# Compact view of an instance holding only the tags a caller asked for
+InstanceRecord = namedtuple("InstanceRecord", ["instance_id", "tags"])
+
+
+def query_instances(ec2_client, filters, tag_keys):
+    """
+    Pages through describe_instances with the selection pushed down as API filters
+    (state, pipeline tags) and the largest page size, yielding InstanceRecords.
+    """
+    paginator = ec2_client.get_paginator("describe_instances")
+    for page in paginator.paginate(Filters=filters, PaginationConfig={"PageSize": 1000}):
+        for reservation in page.get("Reservations", []):
+            for instance in reservation.get("Instances", []):
+                tags = {tag["Key"]: tag["Value"] for tag in instance.get("Tags", []) if tag["Key"] in tag_keys}
+                yield InstanceRecord(instance["InstanceId"], tags)
+
 
 class SensorInstaller:
     def __init__(self):
         self.region = os.getenv('REGION', "us-east-1")
         self.ssm_client = boto3.client('ssm', region_name=self.region)
         self.ec2_client = boto3.client('ec2', region_name=self.region)
+        self.s3_client = boto3.client('s3', region_name=self.region, config=Config(signature_version="s3v4"))
         self.s3_bucket_name = os.getenv("S3_BUCKET_NAME")
         self.timeout = int(os.getenv("RETRY_TIMEOUT", 600))
         self.interval = int(os.getenv("RETRY_WAIT_INTERVAL", 5))
+        self.max_interval = int(os.getenv("RETRY_MAX_WAIT_INTERVAL", 30))
+        self.max_concurrency = os.getenv("SSM_MAX_CONCURRENCY", "50")
+        self.max_errors = os.getenv("SSM_MAX_ERRORS", "100%")
+        self.release_workers = int(os.getenv("RELEASE_WORKERS", 10))
+        self.tag_batch_size = int(os.getenv("TAG_BATCH_SIZE", 500))
+        self.limiter = RateLimiter(float(os.getenv("EC2_MUTATE_RATE", 5)), int(os.getenv("EC2_MUTATE_BURST", 10)))
+        self.wait_timeout = int(os.getenv("WAIT_TIMEOUT", 60))
+        # Runs overlap, an install command is only sent again after it failed or its lease expired
+        self.command_lease = max(int(os.getenv("COMMAND_LEASE_SECONDS", 1800)), 60)
+        # SSM allows up to TimeoutSeconds (at least 30) for delivery, then up to executionTimeout to run,
+        # the lease is split between the two so the command is over before another run may send it again
+        self.delivery_timeout = max(30, self.command_lease // 3)
+        self.execution_timeout = self.command_lease - self.delivery_timeout
+        self.run_id = uuid.uuid4().hex
+        self.command_store = TagCommandStore(self.tag_instances)
+        # Pre-signed URLs and checksums of the installation files, built once per invocation
+        self.artifacts = {}
+        self.url_expiry = int(os.getenv("PRESIGNED_URL_EXPIRY", self.command_lease))
         debug = os.getenv("DEBUG")
         self.debug = True if debug == "True" else False
         self.current_scenario = os.getenv("SCENARIO")
 
-    @staticmethod
-    def get_tag_value(tag_name, tags):
-        for tag in tags:
-            if tag["Key"] == tag_name:
-                return tag["Value"]
+    def get_artifact_checksum(self, object_key):
+        """
+        Returns the hex SHA-256 of an installation file, from its 'sha256' metadata or
+        its S3 SHA-256 checksum. Files uploaded without either are hashed here once.
+        """
+        head = self.s3_client.head_object(Bucket=self.s3_bucket_name, Key=object_key, ChecksumMode="ENABLED")
+        if head.get("Metadata", {}).get("sha256"):
+            return head["Metadata"]["sha256"].lower()
+        # Multipart uploads carry a checksum of the part checksums ('<checksum>-<parts>'), not of the file
+        checksum = head.get("ChecksumSHA256")
+        if checksum and "-" not in checksum:
+            return base64.b64decode(checksum).hex()
+
+        cache_key = (self.s3_bucket_name, object_key, head["ETag"])
+        if cache_key not in artifact_checksum_cache:
+            print(f"WARNING :: '{object_key}' has no stored SHA-256, hashing it")
+            digest = hashlib.sha256()
+            body = self.s3_client.get_object(Bucket=self.s3_bucket_name, Key=object_key)["Body"]
+            for chunk in body.iter_chunks(1024 * 1024):
+                digest.update(chunk)
+            artifact_checksum_cache[cache_key] = digest.hexdigest()
+        return artifact_checksum_cache[cache_key]
+
+    def get_artifact(self, object_key):
+        """
+        Returns the pre-signed URL and SHA-256 of an installation file. The hosts
+        download it directly, without the AWS CLI or an instance role.
+        """
+        if object_key not in self.artifacts:
+            url = self.s3_client.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": self.s3_bucket_name, "Key": object_key},
+                ExpiresIn=self.url_expiry
+            )
+            self.artifacts[object_key] = (url, self.get_artifact_checksum(object_key))
+        return self.artifacts[object_key]
+
+    def get_windows_command(self, binary):
+        downloads = []
+        for object_key in ["DeveloperCertificates.zip", binary, "dlls.zip"]:
+            url, checksum = self.get_artifact(object_key)
+            downloads.append(f"    @{{Url = '{url}'; Path = 'C:\\tools\\{object_key}'; Sha256 = '{checksum}'}}")
+        return [
+            "New-Item -Path \"C:\\tools\" -ItemType Directory -Force | Out-Null",
+
+            # Downloading all installation files in parallel and verifying them
+            "[Net.ServicePointManager]::SecurityProtocol = [Net.SecurityProtocolType]::Tls12",
+            "Add-Type -AssemblyName System.Net.Http",
+            "$downloads = @(",
+            *downloads,
+            ")",
+            "$client = New-Object System.Net.Http.HttpClient",
+            "$client.Timeout = [TimeSpan]::FromMinutes(15)",
+            "$tasks = @($downloads | ForEach-Object { $client.GetByteArrayAsync($_.Url) })",
+            "[System.Threading.Tasks.Task]::WaitAll([System.Threading.Tasks.Task[]]$tasks)",
+            "for ($i = 0; $i -lt $downloads.Count; $i++) { [IO.File]::WriteAllBytes($downloads[$i].Path, $tasks[$i].Result) }",
+            "foreach ($d in $downloads) { if ((Get-FileHash -Path $d.Path -Algorithm SHA256).Hash -ne $d.Sha256) { Write-Error \"Checksum mismatch for $($d.Path)\"; exit 1 } }",
+
+            # Installing Certificates
+            "Expand-Archive -Path \"C:\\tools\\DeveloperCertificates.zip\" -DestinationPath \"C:\\tools\" -Force;",
+            "Start-Process -FilePath \"C:\\tools\\DeveloperCertificates\\InstallCaCert.bat\" -Wait -NoNewWindow;",
+            "Start-Process -FilePath \"C:\\tools\\DeveloperCertificates\\InstallCert.bat\" -Wait -NoNewWindow;",
+
+            # Installing Sensor
+            f"Start-Process -FilePath \"C:\\tools\\{binary}\" -ArgumentList \"/install\",\"/quiet\",\"/norestart\" -Wait -NoNewWindow;",
+
+            # Installing DLLs
+            "Expand-Archive -Path \"C:\\tools\\dlls.zip\" -DestinationPath \"C:\\tools\" -Force;",
+            "Start-Process -FilePath \"C:\\tools\\mitredlls\\switch_dlls.bat\" -Wait -NoNewWindow;",
+            "Remove-Item -Path \"C:\\tools\" -Recurse -Force;",
+
+            # Verifying Installation, up to 60 seconds for the service to start
+            "for ($i = 0; $i -lt 30; $i++) { if ((Get-Service -Name \"CybereasonActiveProbe\" -ErrorAction SilentlyContinue).Status -eq 'Running') { exit 0 }; Start-Sleep -Seconds 2 }",
+            "exit 1"
+        ]
+
+    def get_linux_command(self, binary):
+        url, checksum = self.get_artifact(binary)
+        return [
+            "set -e",
+            "mkdir -p /home/ubuntu/tools",
+            f"curl -fsSL --retry 3 -o /home/ubuntu/tools/{binary} '{url}' || wget -q -O /home/ubuntu/tools/{binary} '{url}'",
+            f"echo '{checksum}  /home/ubuntu/tools/{binary}' | sha256sum -c -",
+            f"dpkg -i /home/ubuntu/tools/{binary}"
+        ]
 
     def get_current_running_instances(self):
-        print("INFO :: Fetching all running instances")
-        instances = []
-        paginator = self.ec2_client.get_paginator("describe_instances")
-        for page in paginator.paginate():
-            for reservation in page.get("Reservations", []):
-                for instance in reservation.get("Instances", []):
-                    if instance["State"]["Name"] == "running":
-                        current_tags = instance.get('Tags', [])
-                        instances.append({"instance_id": instance["InstanceId"], "Tags": current_tags})
-        return instances
+        """
+        Running, isolated instances with SSM access that are still waiting for a sensor.
+        """
+        print("INFO :: Fetching running instances waiting for a sensor")
+        filters = [
+            {"Name": "instance-state-name", "Values": ["running"]},
+            {"Name": "tag:ssm_access", "Values": ["True"]},
+            {"Name": "tag:sensor_installed", "Values": ["False"]},
+            {"Name": "tag:isolated", "Values": ["True"]}
+        ]
+        tag_keys = {"ssm_access", "sensor_installed", "isolated", "platform_details", "architecture",
+                    "security_groups", "previous_instance_profile",
+                    TagCommandStore.COMMAND_TAG, TagCommandStore.LEASE_TAG}
+        return list(query_instances(self.ec2_client, filters, tag_keys))
 
     def send_ssm_command(self, instance_ids: list, commands: list, document_name: str, platform: str):
         try:
             resp = self.ssm_client.send_command(
                 InstanceIds=instance_ids,
                 DocumentName=document_name,
-                Parameters={'commands': commands},
+                # Delivery and execution together fit in the lease, so a retry never overlaps the command
+                Parameters={'commands': commands, 'executionTimeout': [str(self.execution_timeout)]},
+                TimeoutSeconds=self.delivery_timeout,
+                MaxConcurrency=self.max_concurrency,
+                MaxErrors=self.max_errors
             )
             cmd_id = resp['Command']['CommandId']
-            print(f"INFO :: Sent command {cmd_id!r} for all found {platform.title()} platform")
+            print(f"INFO :: Sent command {cmd_id!r} to {len(instance_ids)} {platform.title()} instances")
             return cmd_id
         except ClientError as e:
             print(f"ERROR :: Failed to send command - {e}")
             raise
 
-    def wait_for_command(self, command_id, instance_ids):
-        def upsert_instance(instances, upsert_instance_id, new_status, output):
-            for inst in instances:
-                if inst["instance_id"] == upsert_instance_id:
-                    inst["status"] = new_status
-                    return
-            instances.append({"instance_id": upsert_instance_id, "status": new_status, "output_content": output})
-
-        print(f"INFO :: Waiting for command '{command_id}' to finish...")
-        finished = {i: False for i in instance_ids}
-        results = []
-        while not all(finished.values()):
-            sleep(self.interval)
-            for instance_id in instance_ids:
-                if finished[instance_id]:
+    def list_command_invocations(self, command_id):
+        invocations = {}
+        paginator = self.ssm_client.get_paginator("list_command_invocations")
+        for page in paginator.paginate(CommandId=command_id, Details=True):
+            for invocation in page["CommandInvocations"]:
+                invocations[invocation["InstanceId"]] = invocation
+        return invocations
+
+    def wait_for_commands(self, commands, deadline=None):
+        """
+        Polls the status of every instance of the outstanding commands
+        ({command_id: instance_ids}) with paginated list_command_invocations calls
+        until all of them finished or the deadline (RETRY_TIMEOUT seconds from now
+        by default) passed. Returns {instance_id: {"instance_id", "status",
+        "output_content"}}, instances still running at the deadline keep their last
+        known status.
+        """
+        print(f"INFO :: Waiting for commands {list(commands)} to finish...")
+        deadline = deadline or time() + self.timeout
+        results = {instance_id: {"instance_id": instance_id, "status": "Pending", "output_content": ""}
+                   for instance_ids in commands.values() for instance_id in instance_ids}
+        pending = {command_id: set(instance_ids) for command_id, instance_ids in commands.items()}
+        delay = self.interval
+        while any(pending.values()):
+            sleep(max(min(delay, deadline - time()), 0))
+            finished_now = 0
+            for command_id, pending_ids in pending.items():
+                if not pending_ids:
                     continue
-
-                result = self.ssm_client.get_command_invocation(
-                    CommandId=command_id,
-                    InstanceId=instance_id
-                )
-
-                status = result["Status"]
-                output_content = result["StandardOutputContent"]
-                if status in ["Success", "Failed", "Cancelled", "TimedOut"]:
-                    finished[instance_id] = True
-                    print(f"INFO :: Instance '{instance_id}' - {str(status)}")
-                    if result.get("StandardErrorContent"):
-                        print("    ERROR ::\n", result["StandardErrorContent"])
-                upsert_instance(results, instance_id, status, output_content)
+                try:
+                    invocations = self.list_command_invocations(command_id)
+                except ClientError as e:
+                    if e.response.get("Error", {}).get("Code") not in THROTTLING_ERRORS:
+                        raise
+                    print(f"WARNING :: Throttled polling command '{command_id}' - {e}")
+                    break
+
+                for instance_id in list(pending_ids):
+                    invocation = invocations.get(instance_id)
+                    if not invocation:
+                        continue
+                    status = invocation["Status"]
+                    output_content = "".join(plugin.get("Output", "") for plugin in invocation.get("CommandPlugins", []))
+                    results[instance_id].update(status=status, output_content=output_content)
+                    if status in FINISHED_STATUSES:
+                        pending_ids.discard(instance_id)
+                        finished_now += 1
+                        print(f"INFO :: Instance '{instance_id}' - {str(status)}")
+                        if status != "Success" and output_content:
+                            print("    ERROR ::\n", output_content)
+
+            still_running = sorted(instance_id for pending_ids in pending.values() for instance_id in pending_ids)
+            if still_running and time() >= deadline:
+                print(f"WARNING :: Commands still running on {len(still_running)} instances at the deadline - {still_running}")
+                break
+            # Polling slows down while nothing finishes and speeds up again on progress
+            delay = self.interval if finished_now else min(delay * 1.5, self.max_interval)
         return results
 
+    def get_active_profile_associations(self, instance_id):
+        associations = self.ec2_client.describe_iam_instance_profile_associations(
+            Filters=[{'Name': 'instance-id', 'Values': [instance_id]}]
+        )
+        return [association for association in associations.get("IamInstanceProfileAssociations", [])
+                if association.get("State") in ("associating", "associated", "disassociating")]
+
     def release_isolation(self, instance_id, security_groups, instance_profile):
+        """
+        Restores the security groups and instance profile the instance had before
+        isolation. Every mutating call goes through the shared rate limiter. Releasing
+        an instance again is harmless, a restored profile is left associated.
+        Returns the rollback status of the instance, the release tags are written by
+        the caller for all released instances at once.
+        """
         sg_rollback = False
         ip_rollback = False
         try:
             if security_groups != "None":
                 security_group_ids = [sg["GroupId"] for sg in json.loads(security_groups.replace("'", "\""))]
+                self.limiter.acquire()
                 self.ec2_client.modify_instance_attribute(InstanceId=instance_id, Groups=security_group_ids)
                 print(f"INFO :: Changed back security groups for '{instance_id}'")
                 sg_rollback = True
@@ -94,59 +363,192 @@ class SensorInstaller:
                 print(f"INFO :: The instance '{instance_id}' had no security groups before isolation")
                 sg_rollback = True
         except ClientError as e:
-            print(f"ERROR :: Failed to bring security groups back - {e}")
+            print(f"ERROR :: Failed to bring security groups back for '{instance_id}' - {e}")
 
         try:
-            associations = self.ec2_client.describe_iam_instance_profile_associations(
-                Filters=[{'Name': 'instance-id', 'Values': [instance_id]}]
-            )
-            if "IamInstanceProfileAssociations" in associations and len(
-                    associations["IamInstanceProfileAssociations"]) > 0:
-                for association in associations['IamInstanceProfileAssociations']:
-                    association_id = association['AssociationId']
-                    self.ec2_client.disassociate_iam_instance_profile(AssociationId=association_id)
-                    sleep(10)
-
+            previous_profile_name = None
             if instance_profile != "None":
-                current_instance_profile = json.loads(instance_profile.replace("'", "\""))["Arn"].split("/")[-1]
-                self.ec2_client.associate_iam_instance_profile(
-                    InstanceId=instance_id,
-                    IamInstanceProfile={
-                        'Name': current_instance_profile
-                    }
-                )
+                previous_profile_name = json.loads(instance_profile.replace("'", "\""))["Arn"].split("/")[-1]
+            associations = self.get_active_profile_associations(instance_id)
+            # Another run may have restored the profile already, it is not swapped out again
+            already_restored = (previous_profile_name is not None and len(associations) == 1
+                                and associations[0].get("State") in ("associating", "associated")
+                                and associations[0]["IamInstanceProfile"]["Arn"].split("/")[-1] == previous_profile_name)
+            if already_restored:
                 ip_rollback = True
-                print(f"INFO :: Changed back instance profile for '{instance_id}'")
+                print(f"INFO :: The instance profile of '{instance_id}' is already restored")
             else:
-                print(f"INFO :: The instance '{instance_id}' had no instance profile before isolation")
-                ip_rollback = True
+                if len(associations) > 0:
+                    for association in associations:
+                        association_id = association['AssociationId']
+                        self.limiter.acquire()
+                        self.ec2_client.disassociate_iam_instance_profile(AssociationId=association_id)
+                    wait_until(lambda: len(self.get_active_profile_associations(instance_id)) == 0,
+                               f"the instance profile of '{instance_id}' to be disassociated", self.wait_timeout)
+
+                if previous_profile_name is not None:
+                    def associate():
+                        self.limiter.acquire()
+                        return self.ec2_client.associate_iam_instance_profile(
+                            InstanceId=instance_id,
+                            IamInstanceProfile={
+                                'Name': previous_profile_name
+                            }
+                        )
+
+                    # Retried until EC2 accepts the association, the previous one may still be disassociating
+                    if wait_until(associate, f"instance profile '{previous_profile_name}' to be associated", self.wait_timeout):
+                        ip_rollback = True
+                        print(f"INFO :: Changed back instance profile for '{instance_id}'")
+                else:
+                    print(f"INFO :: The instance '{instance_id}' had no instance profile before isolation")
+                    ip_rollback = True
         except ClientError as e:
-            print(f"ERROR :: Failed to bring instance profile back - {e}")
-
-        if sg_rollback and ip_rollback:
-            self.ec2_client.create_tags(
-                Resources=[instance_id],
-                Tags=[
-                    {'Key': "security_groups", 'Value': "None"},
-                    {'Key': "previous_instance_profile", 'Value': "None"},
-                    {'Key': "ssm_access", 'Value': "N\\A"},
-                    {'Key': "isolated", 'Value': "False"},
-                    {'Key': "last_edited_by", 'Value': "SensorInstallation"}
-                ]
-            )
-        else:
-            print(f"ERROR :: Failed to release '{instance_id}' from isolation")
+            print(f"ERROR :: Failed to bring instance profile back for '{instance_id}' - {e}")
 
-    def run_command_for_instances(self, platform, instance_ids, instance_tags,sensor_commands):
+        if not (sg_rollback and ip_rollback):
+            print(f"ERROR :: Failed to release '{instance_id}' from isolation")
+        return {"instance_id": instance_id, "security_groups": sg_rollback, "instance_profile": ip_rollback,
+                "released": sg_rollback and ip_rollback}
+
+    def tag_instances(self, instance_ids, tags):
+        """
+        Writes the same tags to all instances with one create_tags call per chunk.
+        Returns the instance ids that were tagged.
+        """
+        tagged = []
+        for i in range(0, len(instance_ids), self.tag_batch_size):
+            chunk = instance_ids[i:i + self.tag_batch_size]
+            try:
+                self.limiter.acquire()
+                self.ec2_client.create_tags(Resources=chunk, Tags=tags)
+                tagged.extend(chunk)
+            except ClientError as e:
+                print(f"ERROR :: Failed updating tags for instances {chunk} - {e}")
+        return tagged
+
+    def get_fresh_tags(self, instance_ids, tag_keys):
+        tags = {}
+        for i in range(0, len(instance_ids), DESCRIBE_FILTER_SIZE):
+            chunk = instance_ids[i:i + DESCRIBE_FILTER_SIZE]
+            for instance in query_instances(self.ec2_client, [{"Name": "instance-id", "Values": chunk}], tag_keys):
+                tags[instance.instance_id] = instance.tags
+        return tags
+
+    def claim_release(self, instance_ids):
+        """
+        Overlapping runs resuming the same command all see it succeed. Each writes its
+        claim on the instances still isolated and unclaimed for that command, then
+        reads the tags back and keeps the instances still carrying its own claim.
+        Tags are last-writer-wins, so two runs can still both keep an instance when
+        their writes and reads don't interleave; release_isolation is idempotent for
+        that case. Returns the instance ids claimed by this run.
+        """
+        tag_keys = {"isolated", TagCommandStore.COMMAND_TAG, RELEASE_OWNER_TAG}
+
+        def claim_of(tags):
+            return f"{tags.get(TagCommandStore.COMMAND_TAG)}:{self.run_id}"
+
+        def unclaimed(tags):
+            owner = tags.get(RELEASE_OWNER_TAG) or ""
+            return tags.get("isolated") == "True" and owner.split(":")[0] != tags.get(TagCommandStore.COMMAND_TAG)
+
+        tags = self.get_fresh_tags(instance_ids, tag_keys)
+        candidates = [instance_id for instance_id in instance_ids if unclaimed(tags.get(instance_id, {}))]
+        # The instances of one command share the claim, written for all of them at once
+        claim_groups = {}
+        for instance_id in candidates:
+            claim_groups.setdefault(claim_of(tags[instance_id]), []).append(instance_id)
+        for claim, claim_ids in claim_groups.items():
+            self.tag_instances(claim_ids, [{'Key': RELEASE_OWNER_TAG, 'Value': claim}])
+
+        tags = self.get_fresh_tags(candidates, tag_keys)
+        claimed = [instance_id for instance_id in candidates
+                   if tags.get(instance_id, {}).get("isolated") == "True"
+                   and tags[instance_id].get(RELEASE_OWNER_TAG) == claim_of(tags[instance_id])]
+        skipped = len(instance_ids) - len(claimed)
+        if skipped:
+            print(f"INFO :: {skipped} instances are already released or being released by another run")
+        return claimed
+
+    def release_instances(self, instance_ids, instance_tags):
+        """
+        Releases the instances this run claimed from isolation on a pool of
+        RELEASE_WORKERS threads and returns the rollback status of every instance.
+        """
+        instance_ids = self.claim_release(instance_ids)
+        def release(instance_id):
+            tags = instance_tags[instance_id]
+            try:
+                return self.release_isolation(instance_id, tags.get("security_groups"), tags.get("previous_instance_profile"))
+            except Exception as e:
+                print(f"ERROR :: Failed to release '{instance_id}' from isolation - {e}")
+                return {"instance_id": instance_id, "security_groups": False, "instance_profile": False, "released": False}
+
+        with ThreadPoolExecutor(max_workers=self.release_workers) as executor:
+            statuses = list(executor.map(release, instance_ids))
+
+        released_ids = [status["instance_id"] for status in statuses if status["released"]]
+        tagged_ids = set(self.tag_instances(released_ids, [
+            {'Key': "security_groups", 'Value': "None"},
+            {'Key': "previous_instance_profile", 'Value': "None"},
+            {'Key': "ssm_access", 'Value': "N\\A"},
+            {'Key': "isolated", 'Value': "False"},
+            {'Key': "last_edited_by", 'Value': "SensorInstallation"}
+        ]))
+        for status in statuses:
+            status["tagged"] = status["instance_id"] in tagged_ids
+            print(f"INFO :: Rollback of '{status['instance_id']}' - security groups: {status['security_groups']}, "
+                  f"instance profile: {status['instance_profile']}, tagged: {status['tagged']}")
+        print(f"INFO :: Released {len(tagged_ids)} of {len(statuses)} instances from isolation")
+        return statuses
+
+    def run_rollout(self, groups, instance_tags):
+        """
+        Sends the install command of every platform group in chunks of
+        SEND_COMMAND_BATCH_SIZE instances, so all groups and chunks run on the hosts
+        at the same time, then tracks all outstanding commands together.
+        Instances with a command still leased by an earlier run are not sent a new
+        one, that command is polled instead.
+        'groups' is a list of (platform, instance_ids, document_name, commands).
+        """
         start_time = time()
-        command_id = self.send_ssm_command(instance_ids, sensor_commands, "AWS-RunPowerShellScript" if platform == "windows" else "AWS-RunPowerShellScript", platform)
-        results = self.wait_for_command(command_id, instance_ids)
+        commands = {}
+        for platform, instance_ids, document_name, sensor_commands in groups:
+            dispatch_ids = []
+            for instance_id in instance_ids:
+                command_id = self.command_store.in_flight(instance_tags[instance_id])
+                if command_id:
+                    commands.setdefault(command_id, []).append(instance_id)
+                else:
+                    dispatch_ids.append(instance_id)
+            resumed = len(instance_ids) - len(dispatch_ids)
+            if resumed:
+                print(f"INFO :: Resuming in-flight commands of {resumed} {platform.title()} instances")
+
+            for i in range(0, len(dispatch_ids), SEND_COMMAND_BATCH_SIZE):
+                chunk = dispatch_ids[i:i + SEND_COMMAND_BATCH_SIZE]
+                try:
+                    command_id = self.send_ssm_command(chunk, sensor_commands, document_name, platform)
+                except ClientError:
+                    # Logged by send_ssm_command, the instances are picked up again by the next run
+                    continue
+                commands[command_id] = chunk
+                self.command_store.record(command_id, chunk, self.command_lease)
+
+        if not commands:
+            return
+        results = self.wait_for_commands(commands)
         end_time = time()
         elapsed_seconds = int(end_time - start_time)
         minutes, seconds = divmod(elapsed_seconds, 60)
-        print(f"INFO :: {platform.title()} command ran for {minutes}:{seconds:02d}")
+        print(f"INFO :: Rollout of {len(commands)} commands ran for {minutes}:{seconds:02d}")
+        self.handle_results(results, instance_tags)
 
-        for result in results:
+    def handle_results(self, results, instance_tags):
+        installed_ids = []
+        failed_ids = []
+        for result in results.values():
             cur_instance_id = result["instance_id"]
             cur_status = result["status"]
 
@@ -155,110 +557,78 @@ class SensorInstaller:
                     print(f"WARNING :: Debug is ON - Not attempting to release '{cur_instance_id}' isolation")
                 else:
                     print(f"INFO :: Sensor successfully installed on '{cur_instance_id}'")
-                    self.ec2_client.create_tags(
-                        Resources=[cur_instance_id],
-                        Tags=[
-                            {'Key': "sensor_installed", 'Value': "True"},
-                            {'Key': "last_edited_by", 'Value': "SensorInstallation"}
-                        ]
-                    )
-                    tags = instance_tags[cur_instance_id]
-                    security_groups = self.get_tag_value("security_groups", tags)
-                    instance_profile = self.get_tag_value("previous_instance_profile", tags)
-                    self.release_isolation(cur_instance_id, security_groups, instance_profile)
-            else:
+                    installed_ids.append(cur_instance_id)
+            elif cur_status in FINISHED_STATUSES:
                 print(f"INFO :: Sensor failed to install on '{cur_instance_id}'")
+                failed_ids.append(cur_instance_id)
+            else:
+                print(f"WARNING :: Sensor installation on '{cur_instance_id}' did not finish in time - {cur_status}")
+
+        # A failed command releases its lease, the next run sends a new one
+        if failed_ids:
+            self.command_store.expire(failed_ids)
+
+        installed_ids = self.tag_instances(installed_ids, [
+            {'Key': "sensor_installed", 'Value': "True"},
+            {'Key': "last_edited_by", 'Value': "SensorInstallation"}
+        ])
+        if installed_ids:
+            return self.release_instances(installed_ids, instance_tags)
+        return []
 
     def main(self):
         current_instances = self.get_current_running_instances()
         if len(current_instances) > 0:
             current_windows_instance_ids = []
-            current_windows_instance_tags = {}
-
             current_linux_instance_ids = {"x86_64": [], "arm64": []}
-            current_linux_instance_tags = {}
+            current_instance_tags = {}
+            groups = []
 
             for instance in current_instances:
-                instance_id = instance["instance_id"]
-                tags = instance.get("Tags", [])
-                ssm_access = self.get_tag_value("ssm_access", tags)
-                sensor_installed = self.get_tag_value("sensor_installed", tags)
-                isolated = self.get_tag_value("isolated", tags)
-                platform = self.get_tag_value("platform_details", tags).lower().strip()
-                architecture = self.get_tag_value("architecture", tags)
+                instance_id = instance.instance_id
+                tags = instance.tags
+                ssm_access = tags.get("ssm_access")
+                sensor_installed = tags.get("sensor_installed")
+                isolated = tags.get("isolated")
+                platform = (tags.get("platform_details") or "").lower().strip()
+                architecture = tags.get("architecture")
 
                 if ssm_access == "True" and sensor_installed == "False" and platform == "windows" and isolated == "True":
                     current_windows_instance_ids.append(instance_id)
-                    current_windows_instance_tags.update({instance_id: tags})
-                elif ssm_access == "True" and sensor_installed == "False" and platform == "linux" and isolated == "True":
-                    if architecture == "x86_64":
-                        current_linux_instance_ids["x86_64"].append(instance_id)
-                        current_linux_instance_tags.update({instance_id: tags})
-                    elif architecture == "arm64":
-                        current_linux_instance_ids["arm64"].append(instance_id)
-                        current_linux_instance_tags.update({instance_id: tags})
+                    current_instance_tags.update({instance_id: tags})
+                # EC2 reports Linux hosts as 'Linux/UNIX'
+                elif ssm_access == "True" and sensor_installed == "False" and platform.startswith("linux") and isolated == "True":
+                    if architecture in current_linux_instance_ids:
+                        current_linux_instance_ids[architecture].append(instance_id)
+                        current_instance_tags.update({instance_id: tags})
+
+            def add_group(platform, instance_ids, document_name, get_command, binary):
+                try:
+                    groups.append((platform, instance_ids, document_name, get_command(binary)))
+                except ClientError as e:
+                    # Other platforms still get their sensor, these instances are retried by the next run
+                    print(f"ERROR :: Failed preparing the installation files for {platform.title()} - {e}")
 
             if len(current_windows_instance_ids) > 0:
                 sensor_binary_name = f"CybereasonSensor-x86_64-{self.current_scenario}.exe"
-                windows_sensor_commands = [
-                    "New-Item -Path \"C:\\tools\" -ItemType Directory",
-
-                    # Installing AWS CLI Tool
-                    "$arch = if ($env:PROCESSOR_ARCHITECTURE -eq 'ARM64') {'-arm64'} else {''}",
-                    "$msiName = if ($env:AWSCLI_VERSION) { \"AWSCLIV2-$env:AWSCLI_VERSION$arch.msi\" } else { if ($arch) { \"AWSCLIV2$arch.msi\" } else { \"AWSCLIV2.msi\" } }",
-                    "$url = \"https://awscli.amazonaws.com/$msiName\"",
-                    "$msi = Join-Path $env:TEMP $msiName",
-                    "Invoke-WebRequest -Uri $url -OutFile $msi",
-                    "$log = Join-Path $env:TEMP 'AWSCLI-install.log'",
-                    "Start-Process msiexec.exe -ArgumentList \"/i `\"$msi`\" /qn /norestart /log `\"$log`\"\" -Wait",
-                    "& \"C:\\Program Files\\Amazon\\AWSCLIV2\\aws.exe\" --version",
-
-                    # Installing Certificates
-                    f"& \"C:\\Program Files\\Amazon\\AWSCLIV2\\aws.exe\" s3 cp s3://{self.s3_bucket_name}/DeveloperCertificates.zip C:\\tools\\",
-                    "Expand-Archive -Path \"C:\\tools\\DeveloperCertificates.zip\" -DestinationPath \"C:\\tools\" -Force;",
-                    "Start-Process -FilePath \"C:\\tools\\DeveloperCertificates\\InstallCaCert.bat\" -Wait -NoNewWindow;",
-                    "Start-Process -FilePath \"C:\\tools\\DeveloperCertificates\\InstallCert.bat\" -Wait -NoNewWindow;",
-
-                    # Installing Sensor
-                    f"& \"C:\\Program Files\\Amazon\\AWSCLIV2\\aws.exe\" s3 cp s3://{self.s3_bucket_name}/{sensor_binary_name} C:\\tools\\;",
-                    f"Start-Process -FilePath \"C:\\tools\\{sensor_binary_name}\" -ArgumentList \"/install\",\"/quiet\",\"/norestart\" -Wait -NoNewWindow;",
-
-                    # Installing DLLs
-                    f"& \"C:\\Program Files\\Amazon\\AWSCLIV2\\aws.exe\" s3 cp s3://{self.s3_bucket_name}/dlls.zip C:\\tools\\;",
-                    "Expand-Archive -Path \"C:\\tools\\dlls.zip\" -DestinationPath \"C:\\tools\" -Force;",
-                    "Start-Process -FilePath \"C:\\tools\\mitredlls\\switch_dlls.bat\" -Wait -NoNewWindow;",
-                    "Remove-Item -Path \"C:\\tools\" -Recurse -Force;",
-
-                    # Verifying Installation
-                    "Start-Sleep -Seconds 60",
-                    "if ((Get-Service -Name \"CybereasonActiveProbe\" -ErrorAction SilentlyContinue).Status -eq 'Running') { exit 0 } else { exit 1 }"
-                ]
-                self.run_command_for_instances("windows", current_windows_instance_ids, current_windows_instance_tags, windows_sensor_commands)
+                add_group("windows", current_windows_instance_ids, "AWS-RunPowerShellScript", self.get_windows_command, sensor_binary_name)
             else:
                 print("INFO :: No Windows instances with SSM access found")
 
-            def get_linux_command(binary):
-                return [
-                    "mkdir /home/ubuntu/tools",
-                    f"aws s3 cp s3://{self.s3_bucket_name}/{binary} /home/ubuntu/tools/",
-                    f"dpkg -i /home/ubuntu/tools/{binary}"
-                ]
-
             if len(current_linux_instance_ids["x86_64"]) > 0:
                 sensor_binary_name = f"CybereasonSensor-x86_64-{self.current_scenario}.deb"
-                linux_sensor_commands = get_linux_command(sensor_binary_name)
-                self.run_command_for_instances("linux-amd", current_linux_instance_ids, current_windows_instance_tags, linux_sensor_commands)
+                add_group("linux-amd", current_linux_instance_ids["x86_64"], "AWS-RunShellScript", self.get_linux_command, sensor_binary_name)
             else:
                 print("INFO :: No AMD based Linux instances with SSM access found")
 
             if len(current_linux_instance_ids["arm64"]) > 0:
                 sensor_binary_name = f"CybereasonSensor-arm64-{self.current_scenario}.deb"
-                linux_sensor_commands = get_linux_command(sensor_binary_name)
-                self.run_command_for_instances("linux-arm", current_linux_instance_ids, current_windows_instance_tags,
-                                               linux_sensor_commands)
+                add_group("linux-arm", current_linux_instance_ids["arm64"], "AWS-RunShellScript", self.get_linux_command, sensor_binary_name)
             else:
                 print("INFO :: No ARM based Linux instances with SSM access found")
 
+            self.run_rollout(groups, current_instance_tags)
+
 
 def lambda_handler(event, context):
     SensorInstaller().main()
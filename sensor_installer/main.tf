@@ -15,6 +15,31 @@ variable "retry_wait_interval" {
   type    = number
   default = 5
 }
+variable "ssm_max_concurrency" {
+  type        = string
+  default     = "50"
+  description = "MaxConcurrency of each install command, a number or a percentage"
+}
+variable "command_lease_seconds" {
+  type        = number
+  default     = 1800
+  description = "Seconds an install command is leased to its instances before a later run may send a new one, a third for delivery and the rest for execution (at least 60)"
+}
+variable "release_workers" {
+  type        = number
+  default     = 10
+  description = "Instances released from isolation in parallel"
+}
+variable "ec2_mutate_rate" {
+  type        = number
+  default     = 5
+  description = "Mutating EC2 calls per second shared by the release workers"
+}
+variable "ssm_max_errors" {
+  type        = string
+  default     = "100%"
+  description = "MaxErrors of each install command, a number or a percentage"
+}
 variable "scenario" {
   type = string
   validation {
@@ -33,6 +58,7 @@ data "aws_iam_policy_document" "this" {
     actions = [
       "ssm:SendCommand",
       "ssm:GetCommandInvocation",
+      "ssm:ListCommandInvocations",
       "ec2:DescribeInstances",
       "ec2:ModifyInstanceAttribute",
       "ec2:DescribeIamInstanceProfileAssociations",
@@ -42,6 +68,12 @@ data "aws_iam_policy_document" "this" {
     ]
     resources = ["*"]
   }
+  # Pre-signed URLs of the installation files are only valid if this role can read them
+  statement {
+    effect    = "Allow"
+    actions   = ["s3:GetObject"]
+    resources = ["arn:aws:s3:::${var.s3_bucket_name}/*"]
+  }
 }
 
 resource "aws_lambda_function" "this" {
@@ -58,6 +90,11 @@ resource "aws_lambda_function" "this" {
       S3_BUCKET_NAME      = var.s3_bucket_name
       RETRY_TIMEOUT       = var.retry_timeout
       RETRY_WAIT_INTERVAL = var.retry_wait_interval
+      SSM_MAX_CONCURRENCY = var.ssm_max_concurrency
+      SSM_MAX_ERRORS      = var.ssm_max_errors
+      RELEASE_WORKERS     = var.release_workers
+      COMMAND_LEASE_SECONDS = var.command_lease_seconds
+      EC2_MUTATE_RATE     = var.ec2_mutate_rate
       SCENARIO            = var.scenario
     }
   }
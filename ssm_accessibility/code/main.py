@@ -1,6 +1,45 @@
 import json
 import os
 import boto3
+import random
+from time import sleep
+from collections import namedtuple
+from botocore.exceptions import ClientError
+
+THROTTLING_ERRORS = {"RequestLimitExceeded", "Throttling", "ThrottlingException"}
+# describe_instances accepts at most 200 values per filter
+DESCRIBE_FILTER_SIZE = 200
+
+# Compact view of an instance holding only the tags a caller asked for
+InstanceRecord = namedtuple("InstanceRecord", ["instance_id", "tags"])
+
+
+def query_instances(ec2_client, filters, tag_keys):
+    """
+    Pages through describe_instances with the selection pushed down as API filters
+    (state, pipeline tags) and the largest page size, yielding InstanceRecords.
+    """
+    paginator = ec2_client.get_paginator("describe_instances")
+    for page in paginator.paginate(Filters=filters, PaginationConfig={"PageSize": 1000}):
+        for reservation in page.get("Reservations", []):
+            for instance in reservation.get("Instances", []):
+                tags = {tag["Key"]: tag["Value"] for tag in instance.get("Tags", []) if tag["Key"] in tag_keys}
+                yield InstanceRecord(instance["InstanceId"], tags)
+
+
+def call_with_backoff(api_call, max_attempts=6, base_delay=0.5, max_delay=20, **kwargs):
+    """
+    Calls an AWS API, retrying throttling errors with jittered exponential backoff.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return api_call(**kwargs)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in THROTTLING_ERRORS or attempt == max_attempts - 1:
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            print(f"WARNING :: '{api_call.__name__}' was throttled - retrying in {delay:.1f} seconds")
+            sleep(delay)
 
 
 class SsmAccessibility:
@@ -9,57 +48,149 @@ class SsmAccessibility:
         self.ssm_client = boto3.client('ssm', region_name=self.region)
         self.ec2_client = boto3.client('ec2', region_name=self.region)
         self.parameter_name = os.getenv("PARAMETER_NAME")
+        self.tag_batch_size = int(os.getenv("TAG_BATCH_SIZE", 500))
 
-    def get_ssm_instances(self):
+    def get_ssm_instances(self, instance_ids=None):
+        """
+        Returns the instances currently online in SSM, keyed by instance ID,
+        with their ping status and last ping time.
+        When 'instance_ids' is given only those instances are looked up.
+        """
         print("INFO :: Fetching all available instances visible in SSM")
-        response = self.ssm_client.describe_instance_information()
-        instance_ids = []
-        if "InstanceInformationList" in response and len(response["InstanceInformationList"]) > 0:
-            instance_ids = [instance["InstanceId"] for instance in response["InstanceInformationList"]]
-        return instance_ids
+        instances = {}
+        filter_sets = [[{"Key": "PingStatus", "Values": ["Online"]}]]
+        if instance_ids is not None:
+            filter_sets = [
+                [{"Key": "PingStatus", "Values": ["Online"]}, {"Key": "InstanceIds", "Values": instance_ids[i:i + 50]}]
+                for i in range(0, len(instance_ids), 50)
+            ]
+        paginator = self.ssm_client.get_paginator("describe_instance_information")
+        for filters in filter_sets:
+            for page in paginator.paginate(Filters=filters, PaginationConfig={"PageSize": 50}):
+                for instance in page.get("InstanceInformationList", []):
+                    instances[instance["InstanceId"]] = {
+                        "ping_status": instance.get("PingStatus"),
+                        "last_ping": instance.get("LastPingDateTime")
+                    }
+        print(f"INFO :: Found {len(instances)} online instances in SSM")
+        return instances
 
     def get_current_instance_tags(self):
         pass
 
-    def get_current_instances(self):
-        print("INFO :: Fetching all running instances")
+    def get_current_instances(self, instance_ids=None):
+        """
+        Running instances the pipeline isolated that are still waiting for SSM access,
+        optionally limited to 'instance_ids'.
+        """
+        print("INFO :: Fetching running instances waiting for SSM access")
+        filters = [
+            {"Name": "instance-state-name", "Values": ["running"]},
+            {"Name": "tag:last_edited_by", "Values": ["InstancePipeline"]},
+            {"Name": "tag:ssm_access", "Values": ["False"]}
+        ]
+        tag_keys = {"ssm_access", "last_edited_by"}
+        if instance_ids is None:
+            return list(query_instances(self.ec2_client, filters, tag_keys))
         instances = []
-        paginator = self.ec2_client.get_paginator("describe_instances")
-        for page in paginator.paginate():
-            for reservation in page.get("Reservations", []):
-                for instance in reservation.get("Instances", []):
-                    if instance["State"]["Name"] == "running":
-                        current_tags = instance.get('Tags', [])
-                        instances.append({"instance_id": instance["InstanceId"], "Tags": current_tags})
+        for i in range(0, len(instance_ids), DESCRIBE_FILTER_SIZE):
+            chunk_filters = filters + [{"Name": "instance-id", "Values": instance_ids[i:i + DESCRIBE_FILTER_SIZE]}]
+            instances.extend(query_instances(self.ec2_client, chunk_filters, tag_keys))
         return instances
 
     @staticmethod
-    def get_tag_value(tag_name, tags):
-        for tag in tags:
-            if tag["Key"] == tag_name:
-                return tag["Value"]
-
-    def main(self):
-        current_instance_tags = self.get_current_instances()
-        instances_visible_by_ssm = self.get_ssm_instances()
-
-        for instance in current_instance_tags:
-            instance_id = instance["instance_id"]
-            ssm_access = self.get_tag_value("ssm_access", instance["Tags"])
-            last_edited_by = self.get_tag_value("last_edited_by", instance["Tags"])
+    def get_event_instance_ids(event):
+        """
+        Extracts EC2 instance IDs from an EventBridge event - SSM agent registration
+        (UpdateInstanceInformation through CloudTrail), EC2 state-change notifications,
+        event 'resources' - from a batch of such events buffered in SQS, or from a direct
+        {"instance_ids": [...]} invocation. Every instance is returned once.
+        """
+        instance_ids = set(event.get("instance_ids", []))
+        for record in event.get("Records", []):
+            instance_ids.update(SsmAccessibility.get_event_instance_ids(json.loads(record["body"])))
+        detail = event.get("detail") or {}
+        if "instance-id" in detail:
+            instance_ids.add(detail["instance-id"])
+        request_parameters = detail.get("requestParameters") or {}
+        if "instanceId" in request_parameters:
+            instance_ids.add(request_parameters["instanceId"])
+        for resource in event.get("resources", []):
+            if ":instance/" in resource:
+                instance_ids.add(resource.split("/")[-1])
+        return sorted(instance_id for instance_id in instance_ids if instance_id.startswith("i-"))
 
-            if last_edited_by == "InstancePipeline" and instance_id in instances_visible_by_ssm and ssm_access == "False":
-                print(f"INFO :: Instance '{instance_id}' is accessible by SSM but not in the remote parameter - updating tag")
-                self.ec2_client.create_tags(
-                    Resources=[instance_id],
+    def tag_instances(self, instance_ids):
+        """
+        Writes the SSM access tags with one create_tags call per chunk of instances.
+        Returns the number of API calls made.
+        """
+        api_calls = 0
+        for i in range(0, len(instance_ids), self.tag_batch_size):
+            chunk = instance_ids[i:i + self.tag_batch_size]
+            try:
+                call_with_backoff(
+                    self.ec2_client.create_tags,
+                    Resources=chunk,
                     Tags=[
                         {'Key': "ssm_access", 'Value': "True"},
                         {'Key': "last_edited_by", 'Value': "SsmAccessibility"}
                     ]
                 )
+                print(f"INFO :: Updated SSM access tags for {len(chunk)} instances")
+            except ClientError as e:
+                print(f"ERROR :: Failed updating tags for instances {chunk} - {e}")
+            api_calls += 1
+        return api_calls
+
+    def reconcile(self, current_instance_tags, instances_visible_by_ssm):
+        change_set = []
+        for instance in current_instance_tags:
+            instance_id = instance.instance_id
+            ssm_access = instance.tags.get("ssm_access")
+            last_edited_by = instance.tags.get("last_edited_by")
+
+            if last_edited_by == "InstancePipeline" and instance_id in instances_visible_by_ssm and ssm_access == "False":
+                last_ping = instances_visible_by_ssm[instance_id]["last_ping"]
+                print(f"INFO :: Instance '{instance_id}' is accessible by SSM (last ping {last_ping}) but not tagged - updating tag")
+                change_set.append(instance_id)
             else:
                 print(f"INFO :: No changes required for instance '{instance_id}'")
 
+        if len(change_set) > 0:
+            api_calls = self.tag_instances(change_set)
+            print(f"INFO :: Tagged {len(change_set)} instances with {api_calls} create_tags calls")
+
+    def reconcile_instances(self, instance_ids):
+        """
+        Event driven entry point - reconciles only the given instances instead of scanning the region.
+        """
+        print(f"INFO :: Reconciling {len(instance_ids)} instances from the event")
+        current_instance_tags = self.get_current_instances(instance_ids)
+        if len(current_instance_tags) == 0:
+            print("INFO :: None of the instances are waiting for SSM access")
+            return
+        instances_visible_by_ssm = self.get_ssm_instances([instance.instance_id for instance in current_instance_tags])
+        self.reconcile(current_instance_tags, instances_visible_by_ssm)
+
+    def main(self):
+        current_instance_tags = self.get_current_instances()
+        if len(current_instance_tags) == 0:
+            print("INFO :: No instances are waiting for SSM access")
+            return
+        instances_visible_by_ssm = self.get_ssm_instances()
+        self.reconcile(current_instance_tags, instances_visible_by_ssm)
+
 
 def lambda_handler(event, context):
-    SsmAccessibility().main()
+    event = event or {}
+    if not event or event.get("detail-type") == "Scheduled Event":
+        # Scheduled (or manual) safety sweep over the whole region
+        SsmAccessibility().main()
+        return
+    instance_ids = SsmAccessibility.get_event_instance_ids(event)
+    if len(instance_ids) > 0:
+        SsmAccessibility().reconcile_instances(instance_ids)
+    else:
+        # e.g. heartbeats of hybrid 'mi-' managed instances, never isolated by the pipeline
+        print("INFO :: No EC2 instances in the event")
@@ -1,6 +1,20 @@
 variable "name" {
   type    = string
 }
+variable "sweep_schedule" {
+  description = "Schedule of the full scan, registration events handle the common case"
+  type        = string
+  default     = "rate(15 minutes)"
+}
+variable "registration_batch_size" {
+  type    = number
+  default = 1000
+}
+variable "registration_batch_window" {
+  type        = number
+  default     = 60
+  description = "Seconds SQS collects registration events before invoking the function"
+}
 
 data "aws_iam_policy" "AWSLambdaBasicExecutionRole" {
   arn = "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
@@ -15,6 +29,14 @@ data "aws_iam_policy_document" "this" {
     ]
     resources = ["*"]
   }
+  statement {
+    actions = [
+      "sqs:ReceiveMessage",
+      "sqs:DeleteMessage",
+      "sqs:GetQueueAttributes"
+    ]
+    resources = [aws_sqs_queue.registration.arn]
+  }
 }
 
 resource "aws_lambda_function" "this" {
@@ -56,7 +78,7 @@ resource "aws_iam_policy_attachment" "this" {
 }
 resource "aws_cloudwatch_event_rule" "this" {
   name                = "${var.name}-rule"
-  schedule_expression = "rate(2 minutes)"
+  schedule_expression = var.sweep_schedule
 }
 resource "aws_cloudwatch_event_target" "this" {
   arn       = aws_lambda_function.this.arn
@@ -70,4 +92,60 @@ resource "aws_lambda_permission" "this" {
   statement_id  = "invoke-${var.name}"
   source_arn    = aws_cloudwatch_event_rule.this.arn
   source_account = data.aws_caller_identity.this.account_id
-}
\ No newline at end of file
+}
+# UpdateInstanceInformation is also the SSM agent heartbeat, sent about every 5 minutes by every
+# managed instance. The events are buffered in SQS, so each invocation reconciles the distinct
+# instances of up to 'registration_batch_window' seconds of heartbeats in one filtered lookup.
+resource "aws_cloudwatch_event_rule" "registration" {
+  name          = "${var.name}-registration-rule"
+  event_pattern = <<EOF
+{
+  "source": [
+    "aws.ssm"
+  ],
+  "detail-type": [
+    "AWS API Call via CloudTrail"
+  ],
+  "detail": {
+    "eventSource": [
+      "ssm.amazonaws.com"
+    ],
+    "eventName": [
+      "UpdateInstanceInformation"
+    ]
+  }
+}
+EOF
+}
+resource "aws_cloudwatch_event_target" "registration" {
+  arn       = aws_sqs_queue.registration.arn
+  rule      = aws_cloudwatch_event_rule.registration.name
+  target_id = "${aws_lambda_function.this.id}-registration"
+}
+resource "aws_sqs_queue" "registration" {
+  name                       = "${var.name}-registration-queue"
+  visibility_timeout_seconds = aws_lambda_function.this.timeout + 60
+  # A later heartbeat supersedes an old one, stale events are dropped
+  message_retention_seconds  = 900
+}
+resource "aws_sqs_queue_policy" "registration" {
+  queue_url = aws_sqs_queue.registration.id
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action    = "sqs:SendMessage"
+        Effect    = "Allow"
+        Principal = { Service = "events.amazonaws.com" }
+        Resource  = aws_sqs_queue.registration.arn
+        Condition = { ArnEquals = { "aws:SourceArn" = aws_cloudwatch_event_rule.registration.arn } }
+      },
+    ]
+  })
+}
+resource "aws_lambda_event_source_mapping" "registration" {
+  event_source_arn                   = aws_sqs_queue.registration.arn
+  function_name                      = aws_lambda_function.this.arn
+  batch_size                         = var.registration_batch_size
+  maximum_batching_window_in_seconds = var.registration_batch_window
+}